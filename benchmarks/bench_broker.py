@@ -0,0 +1,50 @@
+##end to end round trips and throughput between two handlers through the embedded broker, no network needed
+##run with: python benchmarks/bench_broker.py
+
+import sys, os, time, tempfile, statistics, threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault('SAMEN_CACHE_PATH', os.path.join(tempfile.mkdtemp(), 'cache.sqlite'))
+from essentials.broker import Broker
+from essentials.intercom import MqttMessageHandler, LOCAL_BROKER_DATA, LOG_POLICY
+
+N = 2000
+NOTICES = 20000
+
+
+def handler(module, peer, port):
+    broker_data = dict(LOCAL_BROKER_DATA, mqtt_port=port, client_id=module, publish_to=[peer], subscribe_to=[module])
+    node = MqttMessageHandler(broker_data=broker_data, my_id=module, logging_policy=dict(LOG_POLICY, output=None))
+    node.start()
+    return node
+
+
+if __name__ == '__main__':
+    broker = Broker(port=0).run_in_thread()
+    webui, nitb = handler('webui', 'nitb', broker.port), handler('nitb', 'webui', broker.port)
+    time.sleep(0.5) # subscriptions go out from on_connect
+    nitb.request_handler = lambda request: nitb.send_message(message_data={'message': 'ok', 'type': 'text'}, reply_to=request)
+    times = []
+    for _ in range(N):
+        start = time.perf_counter()
+        webui.send_request({'message': 'status', 'data_type': 'text', 'to': 'nitb'}).result(timeout=10)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    print(F"{N} round trips: median {statistics.median(times) * 1e6:.0f} us, p99 {times[int(N * 0.99)] * 1e6:.0f} us")
+
+    received, done = [0], threading.Event()
+
+    def count(message):
+        received[0] += 1
+        if received[0] == NOTICES:
+            done.set()
+    nitb.message_handler = count
+    start = time.perf_counter()
+    for number in range(NOTICES):
+        webui.send_message(message_data={'message': str(number), 'type': 'notice', 'data_type': 'text', 'to': 'nitb'})
+    done.wait(60)
+    seconds = time.perf_counter() - start
+    print(F"{received[0]} notices in {seconds:.2f} s, {received[0] / seconds:.0f} messages/s")
+    print(F"broker {broker.stats()}")
+    webui.stop()
+    nitb.stop()
+    broker.stop_thread()
@@ -0,0 +1,54 @@
+##multi-process throughput of the cache backends: the old dbm region against samen.sqlite
+##each worker process opens its own region on the same file and runs a mix of gets and sets
+##each worker stops after OPS operations or SECONDS, whichever comes first, so a slow backend still finishes
+##run with: python benchmarks/bench_cache_backends.py
+
+import sys, os, time, random, tempfile
+from multiprocessing import Pool
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dogpile.cache import make_region
+from essentials.backends import SQLiteBackend # importing it registers samen.sqlite
+
+OPS = 5000
+SECONDS = 3
+KEYS = 1000
+WRITE_SHARE = 0.2
+
+
+def region_for(backend, filename):
+    return make_region().configure(backend, expiration_time=3600, arguments={'filename': filename})
+
+
+#ops per second for one worker
+def worker(args):
+    backend, filename, seed = args
+    region = region_for(backend, filename)
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    deadline, done = start + SECONDS, 0
+    while done < OPS and time.perf_counter() < deadline:
+        done += 1
+        key = F"req:{rng.randrange(KEYS)}"
+        if rng.random() < WRITE_SHARE:
+            region.set(key, {'value': key, 'timestamp': time.time(), 'timeout': 60})
+        else:
+            region.get(key)
+    return done / (time.perf_counter() - start)
+
+
+#total ops per second with the given number of processes
+def bench(backend, filename, processes):
+    region = region_for(backend, filename)
+    assert backend != 'samen.sqlite' or isinstance(region.backend, SQLiteBackend)
+    region.set_multi({F"req:{i}": {'value': i} for i in range(KEYS)})
+    with Pool(processes) as pool:
+        return sum(pool.map(worker, [(backend, filename, seed) for seed in range(processes)]))
+
+
+if __name__ == '__main__':
+    print(F"{'processes':>9} {'dbm ops/s':>10} {'sqlite ops/s':>13}")
+    for processes in (1, 2, 4, 8):
+        with tempfile.TemporaryDirectory() as folder:
+            dbm = bench('dogpile.cache.dbm', os.path.join(folder, 'cache.dbm'), processes)
+            sqlite = bench('samen.sqlite', os.path.join(folder, 'cache.sqlite'), processes)
+        print(F"{processes:>9} {dbm:>10.0f} {sqlite:>13.0f}")
@@ -0,0 +1,39 @@
+##encode/decode throughput and payload size of the wire codecs across message sizes
+##run with: python benchmarks/bench_codec.py
+
+import sys, os, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from essentials.codec import CODECS, decode_payload
+from essentials.message import Message
+
+N = 20000
+
+
+def messages(size):
+    request = Message.request('webui', 'x' * size, to='nitb', cache=(True, 60))
+    return [request, Message.response(request, 'nitb', 'y' * size)]
+
+
+#messages per second through encode and through decode
+def bench(codec, sample):
+    start = time.perf_counter()
+    for _ in range(N // len(sample)):
+        for message in sample:
+            codec.encode(message)
+    encode_rate = N / (time.perf_counter() - start)
+    payloads = [codec.encode(message) for message in sample]
+    start = time.perf_counter()
+    for _ in range(N // len(sample)):
+        for payload in payloads:
+            decode_payload(payload)
+    decode_rate = N / (time.perf_counter() - start)
+    return encode_rate, decode_rate, sum(map(len, payloads)) / len(payloads)
+
+
+if __name__ == '__main__':
+    print(F"{'data bytes':>10} {'codec':>7} {'encode msg/s':>13} {'decode msg/s':>13} {'wire bytes':>11}")
+    for size in (8, 64, 512, 4096):
+        sample = messages(size)
+        for name, codec in CODECS.items():
+            encode_rate, decode_rate, wire = bench(codec, sample)
+            print(F"{size:>10} {name:>7} {encode_rate:>13.0f} {decode_rate:>13.0f} {wire:>11.0f}")
@@ -0,0 +1,49 @@
+##bytes saved against cpu spent by payload compression, with and without the preset dictionary
+##run with: python benchmarks/bench_compression.py
+
+import sys, os, time, zlib, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from essentials.codec import CODECS, Compressor, decode_messages, pack_batch
+from essentials.message import Message
+
+N = 5000
+WORDS = "status ok temperature humidity battery signal online offline door open closed alarm armed motion".split()
+
+
+#what modules send: a short text request and a json response carrying readings
+def messages(size):
+    random.seed(size)
+    text = " ".join(random.choice(WORDS) for _ in range(size // 6))[:size]
+    readings = {F"sensor_{i}": round(random.uniform(0, 100), 2) for i in range(max(1, size // 24))}
+    request = Message.request('webui', text, to='nitb', cache=(True, 60))
+    return [request, Message.response(request, 'nitb', readings, 'json')]
+
+
+def timed(function, payloads):
+    start = time.perf_counter()
+    for _ in range(N // len(payloads)):
+        for payload in payloads:
+            function(payload)
+    return (time.perf_counter() - start) / (N // len(payloads) * len(payloads)) * 1e6
+
+
+def plain(payload):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return b'\x03\x00' + compressor.compress(payload) + compressor.flush()
+
+
+if __name__ == '__main__':
+    compressor = Compressor(threshold=0)
+    codec = CODECS['json']
+    print(F"{'data bytes':>10} {'raw':>7} {'zlib':>7} {'zdict':>7} {'saved':>6} {'compress us':>12} {'decompress us':>14}")
+    for size in (32, 128, 512, 2048, 8192):
+        payloads = [codec.encode(message) for message in messages(size)]
+        packed = [compressor.compress(payload) for payload in payloads]
+        assert [decode_messages(payload) for payload in packed] == [decode_messages(payload) for payload in payloads]
+        raw = sum(map(len, payloads)) / len(payloads)
+        without = sum(len(plain(payload)) for payload in payloads) / len(payloads)
+        with_dict = sum(map(len, packed)) / len(packed)
+        print(F"{size:>10} {raw:>7.0f} {without:>7.0f} {with_dict:>7.0f} {1 - with_dict / raw:>6.0%} "
+              F"{timed(compressor.compress, payloads):>12.1f} {timed(decode_messages, packed) - timed(decode_messages, payloads):>14.1f}")
+    batch = pack_batch([codec.encode(message) for _ in range(10) for message in messages(128)])
+    print(F"batch of 20 messages: {len(batch)} bytes raw, {len(compressor.compress(batch))} compressed")
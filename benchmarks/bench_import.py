@@ -0,0 +1,28 @@
+##import cost of essentials.intercom and proof that importing touches no files
+##run with: python benchmarks/bench_import.py
+
+import sys, os, time, subprocess, tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RUNS = 20
+
+
+def import_time(module, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", F"import {module}"], cwd=ROOT, env=env, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_dir = os.path.join(tmp, "samen")
+        env = dict(os.environ, SAMEN_CACHE_PATH=os.path.join(cache_dir, "cache.sqlite"))
+        baseline = min(import_time("sys", env) for _ in range(RUNS))
+        for module in ("essentials", "essentials.message", "essentials.intercom"):
+            best = min(import_time(module, env) for _ in range(RUNS))
+            print(F"import {module:<22} {(best - baseline) * 1e3:7.1f} ms over a bare interpreter")
+        print(F"cache directory created on import: {os.path.exists(cache_dir)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+##request/response round trips between two modules over the same host transport
+##run with: python benchmarks/bench_local_transport.py
+
+import sys, os, time, tempfile, statistics, threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from essentials.intercom import MqttMessageHandler, BROKER_DATA, LOCAL_POLICY, LOG_POLICY
+
+N = 2000
+
+
+#a handler without a broker, local is all it has
+class LocalOnly(MqttMessageHandler):
+    def get_client(self, broker_data=None, clean_session=True, connect=True):
+        return None
+
+    def publish_payload(self, topic, payload, qos=2, retain=False):
+        raise RuntimeError("fell back to the broker")
+
+
+def handler(module, peer, directory):
+    broker_data = dict(BROKER_DATA, client_id=module, publish_to=[peer], subscribe_to=[module])
+    node = LocalOnly(broker_data=broker_data, dispatch=None, local=dict(LOCAL_POLICY, directory=directory),
+                     logging_policy=dict(LOG_POLICY, output=None))
+    node.local.start(node.receive)
+    node.ticker = threading.Event()
+    threading.Thread(target=node.tick_loop, args=(node.ticker, ), daemon=True).start()
+    return node
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        webui, nitb = handler('webui', 'nitb', directory), handler('nitb', 'webui', directory)
+        nitb.request_handler = lambda request: nitb.send_message(message_data={'message': 'ok', 'type': 'text'}, reply_to=request)
+        webui.response_handler = None
+        times = []
+        for _ in range(N):
+            start = time.perf_counter()
+            webui.send_request({'message': 'status', 'data_type': 'text', 'to': 'nitb'}).result(timeout=5)
+            times.append(time.perf_counter() - start)
+        times.sort()
+        print(F"{N} local round trips: median {statistics.median(times) * 1e6:.0f} us, p99 {times[int(N * 0.99)] * 1e6:.0f} us")
+        print(F"webui {webui.local.stats()}, nitb {nitb.local.stats()}")
+        webui.local.stop()
+        nitb.local.stop()
@@ -0,0 +1,68 @@
+##cost of building and encoding a message: the old MESSAGE_TEMPLATE path against Message
+##run with: python benchmarks/bench_message.py
+
+import sys, os, time, json, hashlib, tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from essentials.message import Message
+
+N = 50000
+TEMPLATE = {
+    "id": "", "type": "", "from": "", "to": "all", "timestamp": "",
+    "data": {'message': "", 'type': ""}, 'req_id': "", 're_timestamp': "", "cache": [False, 0],
+}
+
+
+#prepare_message as it was, filling in the shared template
+def legacy_shared(text):
+    message = TEMPLATE
+    message['data'] = {'message': text, 'type': 'text'}
+    message['to'], message['from'], message['type'] = 'all', 'bench', 'request'
+    message['id'] = hashlib.md5(json.dumps(message['data']).encode('utf-8')).hexdigest()
+    message['timestamp'], message['cache'] = time.time(), [False, 0]
+    return message
+
+
+#the same with a fresh dict per message, what the old path needed to be safe across threads
+def legacy_copy(text):
+    message = dict(TEMPLATE)
+    message['data'] = {'message': text, 'type': 'text'}
+    message['to'], message['from'], message['type'] = 'all', 'bench', 'request'
+    message['id'] = hashlib.md5(json.dumps(message['data']).encode('utf-8')).hexdigest()
+    message['timestamp'], message['cache'] = time.time(), [False, 0]
+    return message
+
+
+def new_message(text):
+    return Message.request('bench', text)
+
+
+#us per message to build and encode
+def bench_time(build, encode):
+    texts = [F"status {i}" for i in range(N)]
+    start = time.perf_counter()
+    for text in texts:
+        encode(build(text))
+    return (time.perf_counter() - start) / N * 1e6
+
+
+#bytes and allocated blocks per message kept alive
+def bench_memory(build):
+    texts = [F"status {i}" for i in range(N)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [build(text) for text in texts]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    size = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    del kept
+    return size / N, blocks / N
+
+
+if __name__ == '__main__':
+    print(F"{'path':>14} {'build+encode us':>16} {'bytes/msg':>10} {'blocks/msg':>11}")
+    print(F"{'shared dict':>14} {bench_time(legacy_shared, json.dumps):>16.2f} {'n/a':>10} {'n/a':>11}")
+    for name, build, encode in (('dict per msg', legacy_copy, json.dumps), ('Message', new_message, Message.to_wire)):
+        size, blocks = bench_memory(build)
+        print(F"{name:>14} {bench_time(build, encode):>16.2f} {size:>10.0f} {blocks:>11.1f}")
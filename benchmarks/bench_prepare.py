@@ -0,0 +1,34 @@
+##prepare_message hot path: the md5-of-json id it used to compute against the generated id
+##run with: python benchmarks/bench_prepare.py
+
+import sys, os, time, json, hashlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from essentials.message import Message
+
+N = 50000
+
+
+#how ids were made before, a second json.dumps and an md5 for every message
+def legacy(text, cache):
+    data = {'message': text, 'type': 'text'}
+    return Message(hashlib.md5(json.dumps(data).encode('utf-8')).hexdigest(), 'request', 'bench', 'all', time.time(), data, cache=cache)
+
+
+def current(text, cache):
+    return Message.new('request', 'bench', text, 'text', cache=cache)
+
+
+#us per message
+def bench(build, cache):
+    texts = [F"status {i}" for i in range(N)]
+    start = time.perf_counter()
+    for text in texts:
+        build(text, cache)
+    return (time.perf_counter() - start) / N * 1e6
+
+
+if __name__ == '__main__':
+    print(F"{'path':>22} {'us/msg':>8}")
+    print(F"{'md5 id':>22} {bench(legacy, (False, 0)):>8.2f}")
+    print(F"{'new_id':>22} {bench(current, (False, 0)):>8.2f}")
+    print(F"{'new_id + cache key':>22} {bench(current, (True, 60)):>8.2f}")
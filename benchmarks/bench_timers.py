@@ -0,0 +1,45 @@
+##schedule/cancel cost of the timing wheel against a heap as the number of in-flight timers grows
+##run with: python benchmarks/bench_timers.py
+
+import sys, os, time, heapq, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from essentials.timers import TimingWheel
+
+OPS = 20000
+
+
+def noop(*args):
+    pass
+
+
+#ns per schedule+cancel with in_flight timers already running
+def bench_wheel(in_flight):
+    wheel = TimingWheel(tick=0.1)
+    for _ in range(in_flight):
+        wheel.schedule(random.uniform(1, 600), noop)
+    delays = [random.uniform(1, 600) for _ in range(OPS)]
+    start = time.perf_counter()
+    for delay in delays:
+        wheel.cancel(wheel.schedule(delay, noop))
+    return (time.perf_counter() - start) / OPS * 1e9
+
+
+#same workload on a heap with lazy deletion, the usual alternative
+def bench_heap(in_flight):
+    heap, cancelled = [], set()
+    now = time.monotonic()
+    for i in range(in_flight):
+        heapq.heappush(heap, (now + random.uniform(1, 600), i, noop))
+    delays = [random.uniform(1, 600) for _ in range(OPS)]
+    start = time.perf_counter()
+    for i, delay in enumerate(delays, in_flight):
+        entry = (now + delay, i, noop)
+        heapq.heappush(heap, entry)
+        cancelled.add(i)
+    return (time.perf_counter() - start) / OPS * 1e9
+
+
+if __name__ == '__main__':
+    print(F"{'in flight':>10} {'wheel ns/op':>12} {'heap ns/op':>12}")
+    for in_flight in (1000, 10000, 50000, 100000, 500000):
+        print(F"{in_flight:>10} {bench_wheel(in_flight):>12.0f} {bench_heap(in_flight):>12.0f}")
@@ -1,17 +1,11 @@
-from dogpile.cache import make_region
-import os 
+#importing the package does no disk work, the shared cache is built by the first get_cache()
+#`from essentials import cache` gives the cache module, the region is essentials.cache.cache or get_cache()
 
 
-cache_path = "/var/lib/samen/cache.dbm"
-
-if not os.path.exists(os.path.dirname(cache_path)):
-    os.makedirs(os.path.dirname(cache_path))
-
-cache = make_region().configure(
-    'dogpile.cache.dbm',
-    expiration_time=3600,
-    arguments={'filename': cache_path}
-)
+def get_cache():
+    from .cache import get_cache
+    return get_cache()
 
+# cache = get_cache()
 # cache.set('my_key', 'my_value', expiration_time=60)
-# my_value = cache.get('my_key')
\ No newline at end of file
+# my_value = cache.get('my_key')
@@ -0,0 +1,181 @@
+##sqlite cache backend for dogpile, shared safely by every process on the box
+##WAL mode lets readers run alongside a writer, every row carries an indexed expires_at
+##so expired entries are skipped on read and can be deleted in bulk by the Sweeper
+
+import os, pickle, sqlite3, threading, time, logging
+from dogpile.cache.api import CacheBackend, NO_VALUE
+from dogpile.cache.region import register_backend
+
+log = logging.getLogger('samen.cache')
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)",
+    "CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)",
+)
+MAX_VARIABLES = 900 # sqlite's limit on ? placeholders is 999 on older builds
+
+
+#arguments: filename, expiration_time (seconds a row lives, None for ever), busy_timeout (seconds to wait on a lock),
+#on_write (called with the key and size in bytes of every row written)
+class SQLiteBackend(CacheBackend):
+    def __init__(self, arguments) -> None:
+        self.filename = arguments['filename']
+        self.expiration_time = arguments.get('expiration_time')
+        self.busy_timeout = arguments.get('busy_timeout', 5)
+        self.on_write = arguments.get('on_write')
+        self.local = threading.local()
+        with self.connection() as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+    #one connection per thread and process, sqlite connections must not cross either
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.filename, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            # only takes on an empty file and must come before journal_mode, which writes the header. compact() converts older files
+            db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL") # durable at checkpoints, a cache can lose the last writes on power loss
+            self.local.db, self.local.pid = db, os.getpid()
+        return db
+
+    def expires_at(self):
+        return time.time() + self.expiration_time if self.expiration_time else None
+
+    def get(self, key):
+        row = self.connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row else NO_VALUE
+
+    def get_multi(self, keys):
+        keys, found, now = list(keys), {}, time.time()
+        db = self.connection()
+        for start in range(0, len(keys), MAX_VARIABLES):
+            chunk = keys[start:start + MAX_VARIABLES]
+            rows = db.execute("SELECT key, value FROM cache WHERE key IN (%s) AND (expires_at IS NULL OR expires_at > ?)"
+                              % ",".join("?" * len(chunk)), (*chunk, now))
+            found.update(rows)
+        return [pickle.loads(found[key]) if key in found else NO_VALUE for key in keys]
+
+    def set(self, key, value):
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.connection().execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, blob, self.expires_at()))
+        if self.on_write:
+            self.on_write(key, len(blob))
+
+    #all rows in one transaction, one fsync instead of one per key
+    def set_multi(self, mapping):
+        expires_at = self.expires_at()
+        rows = [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires_at) for key, value in mapping.items()]
+        with self.connection() as db:
+            db.execute("BEGIN")
+            db.executemany("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", rows)
+        if self.on_write:
+            for key, blob, _ in rows:
+                self.on_write(key, len(blob))
+
+    def delete(self, key):
+        self.connection().execute("DELETE FROM cache WHERE key = ?", (key, ))
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        with self.connection() as db:
+            db.execute("BEGIN")
+            for start in range(0, len(keys), MAX_VARIABLES):
+                chunk = keys[start:start + MAX_VARIABLES]
+                db.execute("DELETE FROM cache WHERE key IN (%s)" % ",".join("?" * len(chunk)), chunk)
+
+    #bytes held by live pages, free pages excluded
+    def size(self):
+        db = self.connection()
+        page_size, = db.execute("PRAGMA page_size").fetchone()
+        pages, = db.execute("PRAGMA page_count").fetchone()
+        free, = db.execute("PRAGMA freelist_count").fetchone()
+        return (pages - free) * page_size
+
+    #bytes on disk, database and write-ahead log
+    def file_size(self):
+        return sum(os.path.getsize(name) for name in (self.filename, self.filename + '-wal') if os.path.exists(name))
+
+    #deletes up to limit expired rows, returns how many went
+    def delete_expired(self, limit=500):
+        return self.connection().execute(
+            "DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache WHERE expires_at <= ? LIMIT ?)", (time.time(), limit)).rowcount
+
+    #deletes up to limit rows closest to expiry, rows that never expire go last
+    def delete_soonest(self, limit=500):
+        return self.connection().execute(
+            "DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY expires_at IS NULL, expires_at LIMIT ?)", (limit, )).rowcount
+
+    #hands free pages back to the filesystem and truncates the write-ahead log
+    def compact(self, pages=2000):
+        db = self.connection()
+        mode, = db.execute("PRAGMA auto_vacuum").fetchone()
+        if mode != 2: # a file made before incremental vacuum, needs one full rewrite to switch
+            db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            db.execute("VACUUM")
+        else:
+            db.execute(F"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+
+#deletes expired rows in the background and keeps the file under max_bytes
+#work is done in batches with a pause between them so writers on the message path get the lock
+class Sweeper:
+    def __init__(self, backend, interval=60, batch=500, max_bytes=256 * 2**20, compact_every=10, pause=0.01) -> None:
+        self.backend, self.interval, self.batch, self.max_bytes = backend, interval, batch, max_bytes
+        self.compact_every, self.pause = compact_every, pause
+        self.sweeps = self.removed = self.evicted = self.reclaimed = 0
+        self.last_duration = self.total_duration = 0.0
+        self.stopped = None
+
+    def sweep(self):
+        start, before = time.perf_counter(), self.backend.file_size()
+        removed = evicted = 0
+        while True:
+            count = self.backend.delete_expired(self.batch)
+            removed += count
+            if count < self.batch:
+                break
+            time.sleep(self.pause)
+        over = self.backend.size() > self.max_bytes
+        while self.backend.size() > self.max_bytes:
+            count = self.backend.delete_soonest(self.batch)
+            evicted += count
+            if not count:
+                break
+            time.sleep(self.pause)
+        self.sweeps += 1
+        if over or self.sweeps % self.compact_every == 0:
+            self.backend.compact()
+        self.last_duration = time.perf_counter() - start
+        self.total_duration += self.last_duration
+        self.removed, self.evicted = self.removed + removed, self.evicted + evicted
+        self.reclaimed += max(0, before - self.backend.file_size())
+        return removed, evicted
+
+    def run(self, stopped):
+        while not stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except sqlite3.Error as e: # a locked or busy database is retried on the next round
+                log.warning("cache sweep failed: %r", e)
+
+    #starts the background thread, does nothing if it is already running
+    def start(self):
+        if self.stopped is None:
+            self.stopped = threading.Event()
+            threading.Thread(target=self.run, args=(self.stopped, ), daemon=True).start()
+
+    def stop(self):
+        if self.stopped is not None:
+            self.stopped.set()
+            self.stopped = None
+
+    def stats(self):
+        return {'sweeps': self.sweeps, 'rows_removed': self.removed, 'rows_evicted': self.evicted,
+                'bytes_reclaimed': self.reclaimed, 'last_duration': self.last_duration, 'total_duration': self.total_duration}
+
+
+register_backend("samen.sqlite", __name__, "SQLiteBackend")
@@ -0,0 +1,75 @@
+##coalesces small outgoing messages into one publish per topic
+##a topic's buffer is sent once it holds `size` messages or its oldest message has waited `delay` seconds,
+##both come from the policy of the message types in it, types without a policy are never held back
+##messages are only batched with others of the same qos, retained messages are never batched
+
+import threading, time
+from .codec import pack_batch
+
+
+class TopicBuffer:
+    __slots__ = ('payloads', 'limit', 'deadline', 'timer')
+
+    def __init__(self) -> None:
+        self.payloads, self.limit, self.deadline, self.timer = [], None, None, None
+
+
+class Batcher:
+    # publish(topic, payload, qos) sends one frame, wheel times the delays, policy is {type: {'size': n, 'delay': seconds}}
+    def __init__(self, publish, wheel, policy) -> None:
+        self.publish, self.wheel, self.policy = publish, wheel, policy
+        self.buffers = {}
+        self.batches = self.batched = 0
+        self.lock = threading.Lock()
+
+    #holds an encoded message for its topic, returns False if its type is not batched and must be sent now
+    def add(self, topic, message, payload, qos=2, retain=False):
+        policy = self.policy.get(message['type'])
+        if not policy or retain:
+            self.flush(topic) # keep order, what was held for the topic goes out before this one
+            return False
+        key, flush = (topic, qos), None
+        with self.lock:
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                buffer = self.buffers[key] = TopicBuffer()
+            buffer.payloads.append(payload)
+            buffer.limit = min(buffer.limit or policy['size'], policy['size'])
+            if len(buffer.payloads) >= buffer.limit:
+                flush = self.take(key)
+            elif buffer.deadline is None or time.monotonic() + policy['delay'] < buffer.deadline:
+                # the tightest latency budget in the buffer decides when it goes
+                self.wheel.cancel(buffer.timer)
+                buffer.deadline = time.monotonic() + policy['delay']
+                buffer.timer = self.wheel.schedule(policy['delay'], self.flush, topic, qos)
+        if flush:
+            self.send(key, flush)
+        return True
+
+    #removes a buffer, call with the lock held
+    def take(self, key):
+        buffer = self.buffers.pop(key, None)
+        if buffer is None:
+            return None
+        self.wheel.cancel(buffer.timer)
+        return buffer.payloads
+
+    def send(self, key, payloads):
+        self.batches += 1
+        self.batched += len(payloads)
+        topic, qos = key
+        self.publish(topic, payloads[0] if len(payloads) == 1 else pack_batch(payloads), qos)
+
+    #sends whatever is buffered for a topic (at one qos or all), or for every topic
+    def flush(self, topic=None, qos=None):
+        with self.lock:
+            keys = [key for key in self.buffers if topic in (None, key[0]) and qos in (None, key[1])]
+            taken = [(key, self.take(key)) for key in keys]
+        for key, payloads in taken:
+            if payloads:
+                self.send(key, payloads)
+
+    def stats(self):
+        with self.lock:
+            buffered = sum(len(buffer.payloads) for buffer in self.buffers.values())
+        return {'batches': self.batches, 'batched': self.batched, 'buffered': buffered}
@@ -0,0 +1,345 @@
+##a small mqtt 3.1.1 broker on asyncio, for tests and benchmarks without the hosted broker. not for production
+##qos 0, 1 and 2, retained messages, + and # wildcards, wills and keepalive. sessions are always clean:
+##subscriptions and unacknowledged messages go with the connection and nothing is written to disk
+##run as python -m essentials.broker [--host 127.0.0.1] [--port 1883], or in process with Broker.start() or
+##Broker.run_in_thread(), and point a handler at it with intercom.LOCAL_BROKER_DATA
+
+import argparse, asyncio, logging, socket, struct, threading
+from paho.mqtt.matcher import MQTTMatcher
+from paho.mqtt.client import topic_matches_sub
+
+log = logging.getLogger('samen.broker')
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = range(1, 15)
+PACKET_ID = struct.Struct('!H')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+#what parsing a truncated or garbled packet raises besides ProtocolError, ValueError covers bad utf-8
+MALFORMED = (ProtocolError, struct.error, ValueError, IndexError)
+
+
+def encode_length(length):
+    out = bytearray()
+    while True:
+        length, byte = divmod(length, 128)
+        out.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(out)
+
+
+def packet(kind, flags, body=b''):
+    return bytes(((kind << 4) | flags, )) + encode_length(len(body)) + body
+
+
+def string(value):
+    return PACKET_ID.pack(len(value)) + value
+
+
+def read_string(body, offset):
+    if offset + 2 > len(body):
+        raise ProtocolError("truncated string")
+    length, = PACKET_ID.unpack_from(body, offset)
+    if offset + 2 + length > len(body):
+        raise ProtocolError("truncated string")
+    return body[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+def valid_filter(topic_filter):
+    levels = topic_filter.split('/')
+    return bool(topic_filter) and all(
+        ('+' not in level or level == '+') and ('#' not in level or (level == '#' and index == len(levels) - 1))
+        for index, level in enumerate(levels))
+
+
+#one client connection
+class Session:
+    def __init__(self, broker, reader, writer) -> None:
+        self.broker, self.reader, self.writer = broker, reader, writer
+        self.client_id, self.keepalive, self.will = None, 0, None
+        self.subscriptions = {} # filter -> granted qos
+        self.outgoing = {} # packet id -> qos, deliveries waiting for their acknowledgement
+        self.incoming = set() # qos 2 packet ids delivered and waiting for PUBREL
+        self.next_id = 0
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def new_packet_id(self):
+        for _ in range(65535):
+            self.next_id = self.next_id % 65535 + 1
+            if self.next_id not in self.outgoing:
+                return self.next_id
+        raise ProtocolError("every packet id is waiting for an acknowledgement")
+
+    async def read_packet(self):
+        header = (await self.reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        for _ in range(4):
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        else:
+            raise ProtocolError("remaining length over four bytes")
+        if length > self.broker.max_packet:
+            raise ProtocolError(F"packet of {length} bytes")
+        return header >> 4, header & 0x0f, await self.reader.readexactly(length) if length else b''
+
+    async def run(self):
+        try:
+            kind, flags, body = await asyncio.wait_for(self.read_packet(), self.broker.connect_timeout)
+            if kind != CONNECT or not self.connect(body):
+                return
+            while True:
+                kind, flags, body = await asyncio.wait_for(self.read_packet(), self.keepalive * 1.5 if self.keepalive else None)
+                if kind == DISCONNECT:
+                    self.will = None
+                    return
+                self.handle(kind, flags, body)
+                if self.writer.transport.get_write_buffer_size() > self.broker.high_water:
+                    await self.writer.drain() # a client that does not read slows down its own publishing
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except MALFORMED as e:
+            log.warning("closing %s: %r", self.client_id, e)
+        finally:
+            self.broker.disconnected(self)
+
+    def connect(self, body):
+        name, offset = read_string(body, 0)
+        if name != b'MQTT' or offset + 4 > len(body) or body[offset] != 4:
+            self.send(packet(CONNACK, 0, b'\x00\x01')) # unacceptable protocol version
+            return False
+        flags, (self.keepalive, ) = body[offset + 1], PACKET_ID.unpack_from(body, offset + 2)
+        client_id, offset = read_string(body, offset + 4)
+        if flags & 0x04:
+            topic, offset = read_string(body, offset)
+            message, offset = read_string(body, offset)
+            self.will = (topic, message, (flags >> 3) & 3, bool(flags & 0x20))
+        username = password = None
+        if flags & 0x80:
+            username, offset = read_string(body, offset)
+        if flags & 0x40:
+            password, offset = read_string(body, offset)
+        if self.broker.users is not None and self.broker.users.get((username or b'').decode('utf-8')) != (password or b'').decode('utf-8'):
+            self.send(packet(CONNACK, 0, b'\x00\x05')) # not authorized
+            return False
+        self.client_id = client_id.decode('utf-8') or F"samen-{id(self):x}"
+        self.broker.connected(self)
+        self.send(packet(CONNACK, 0, b'\x00\x00'))
+        return True
+
+    def handle(self, kind, flags, body):
+        if kind == PUBLISH:
+            qos, retain = (flags >> 1) & 3, bool(flags & 1)
+            topic, offset = read_string(body, 0)
+            if qos == 3 or b'+' in topic or b'#' in topic:
+                raise ProtocolError("bad publish")
+            packet_id = None
+            if qos:
+                packet_id, = PACKET_ID.unpack_from(body, offset)
+                offset += 2
+            payload = body[offset:]
+            if qos == 2:
+                if packet_id not in self.incoming: # a resend of one already delivered is only acknowledged again
+                    self.incoming.add(packet_id)
+                    self.broker.publish(topic, payload, qos, retain)
+                self.send(packet(PUBREC, 0, PACKET_ID.pack(packet_id)))
+                return
+            self.broker.publish(topic, payload, qos, retain)
+            if qos == 1:
+                self.send(packet(PUBACK, 0, PACKET_ID.pack(packet_id)))
+        elif kind == PUBACK or kind == PUBCOMP:
+            self.outgoing.pop(PACKET_ID.unpack_from(body)[0], None)
+        elif kind == PUBREC:
+            self.send(packet(PUBREL, 2, body[:2]))
+        elif kind == PUBREL:
+            self.incoming.discard(PACKET_ID.unpack_from(body)[0])
+            self.send(packet(PUBCOMP, 0, body[:2]))
+        elif kind == SUBSCRIBE:
+            packet_id, offset, granted, wanted = body[:2], 2, bytearray(), []
+            while offset < len(body):
+                topic_filter, offset = read_string(body, offset)
+                qos, offset = body[offset] if offset < len(body) else 3, offset + 1
+                topic_filter = topic_filter.decode('utf-8')
+                if qos > 2 or not valid_filter(topic_filter):
+                    granted.append(0x80)
+                    continue
+                self.broker.subscribe(self, topic_filter, qos)
+                granted.append(qos)
+                wanted.append((topic_filter, qos))
+            self.send(packet(SUBACK, 0, packet_id + bytes(granted)))
+            for topic_filter, qos in wanted:
+                self.broker.send_retained(self, topic_filter, qos)
+        elif kind == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                topic_filter, offset = read_string(body, offset)
+                self.broker.unsubscribe(self, topic_filter.decode('utf-8'))
+            self.send(packet(UNSUBACK, 0, body[:2]))
+        elif kind == PINGREQ:
+            self.send(packet(PINGRESP, 0))
+        else:
+            raise ProtocolError(F"unexpected packet type {kind}")
+
+    def deliver(self, topic, payload, qos, retain=False):
+        if self.writer.transport.get_write_buffer_size() > self.broker.max_buffer:
+            if qos == 0: # a subscriber this far behind loses qos 0 messages rather than the broker's memory
+                self.broker.dropped += 1
+                return
+        head = string(topic)
+        if qos:
+            packet_id = self.new_packet_id()
+            self.outgoing[packet_id] = qos
+            head += PACKET_ID.pack(packet_id)
+        self.send(packet(PUBLISH, (qos << 1) | retain, head + payload))
+        self.broker.delivered += 1
+
+    def close(self):
+        self.will = None
+        self.writer.close()
+
+
+class Broker:
+    # users is {username: password} to check logins against, None lets everyone in
+    def __init__(self, host='127.0.0.1', port=1883, users=None, max_packet=256 * 2**20, connect_timeout=10,
+                 high_water=2**20, max_buffer=64 * 2**20) -> None:
+        self.host, self.port, self.users, self.max_packet, self.connect_timeout = host, port, users, max_packet, connect_timeout
+        self.high_water, self.max_buffer = high_water, max_buffer
+        self.sessions = {} # client id -> Session
+        self.tasks = set() # one per open connection, connected or not
+        self.subscriptions = MQTTMatcher() # filter -> {session: qos}
+        self.retained = {} # topic -> (payload, qos)
+        self.server = self.loop = self.thread = None
+        self.published = self.delivered = self.dropped = 0
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.accept, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1] # the one picked when port was 0
+        return self
+
+    async def stop(self):
+        self.server.close()
+        for session in list(self.sessions.values()):
+            session.close()
+        tasks = list(self.tasks)
+        for task in tasks: # connections still waiting for their CONNECT are not in sessions
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def accept(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            await Session(self, reader, writer).run()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.tasks.discard(task)
+
+    #runs the broker on a loop of its own in a daemon thread, returns once it is listening
+    def run_in_thread(self):
+        ready = threading.Event()
+
+        async def serve():
+            await self.start()
+            self.finished = asyncio.Event()
+            ready.set()
+            await self.finished.wait() # not serve_forever(), closing the server would cancel stop() half way
+
+        def run():
+            asyncio.run(serve())
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop_thread(self):
+        if self.thread is not None:
+            asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.finished.set)
+            self.thread.join()
+            self.thread = None
+
+    def connected(self, session):
+        previous = self.sessions.get(session.client_id)
+        if previous is not None: # a client id connects once, the newer connection takes over
+            previous.close()
+        self.sessions[session.client_id] = session
+
+    def disconnected(self, session):
+        if session.client_id is not None and self.sessions.get(session.client_id) is session:
+            del self.sessions[session.client_id]
+        for topic_filter in list(session.subscriptions):
+            self.unsubscribe(session, topic_filter)
+        if session.will:
+            self.publish(*session.will)
+        session.writer.close()
+
+    def subscribe(self, session, topic_filter, qos):
+        try:
+            subscribers = self.subscriptions[topic_filter]
+        except KeyError:
+            subscribers = self.subscriptions[topic_filter] = {}
+        subscribers[session] = qos
+        session.subscriptions[topic_filter] = qos
+
+    def unsubscribe(self, session, topic_filter):
+        session.subscriptions.pop(topic_filter, None)
+        try:
+            subscribers = self.subscriptions[topic_filter]
+        except KeyError:
+            return
+        subscribers.pop(session, None)
+        if not subscribers:
+            del self.subscriptions[topic_filter]
+
+    def publish(self, topic, payload, qos, retain=False):
+        self.published += 1
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else: # an empty retained message clears the topic
+                self.retained.pop(topic, None)
+        targets = {} # overlapping subscriptions give one delivery at the highest qos granted
+        for subscribers in self.subscriptions.iter_match(topic.decode('utf-8')):
+            for session, granted in subscribers.items():
+                targets[session] = max(targets.get(session, 0), min(qos, granted))
+        for session, delivery_qos in targets.items():
+            session.deliver(topic, payload, delivery_qos)
+
+    def send_retained(self, session, topic_filter, qos):
+        for topic, (payload, retained_qos) in list(self.retained.items()):
+            if topic_matches_sub(topic_filter, topic.decode('utf-8')):
+                session.deliver(topic, payload, min(qos, retained_qos), retain=True)
+
+    def stats(self):
+        return {'sessions': len(self.sessions), 'retained': len(self.retained), 'published': self.published,
+                'delivered': self.delivered, 'dropped': self.dropped}
+
+
+async def serve(host, port):
+    broker = await Broker(host, port).start()
+    log.info("listening on %s:%s", host, broker.port)
+    await broker.server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local mqtt broker for tests and benchmarks')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=1883, help='port to listen on, 0 picks a free one')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(args.host, args.port))
@@ -1,17 +1,238 @@
 from dogpile.cache import make_region
-import os 
+from dogpile.cache.api import NO_VALUE
+from collections import OrderedDict
+import os, time, threading
+from .backends import Sweeper # importing backends registers samen.sqlite
+from .metrics import Histogram
 
+#nothing is opened or created on import, the region is built by the first get_cache()
+#SAMEN_CACHE_PATH and SAMEN_CACHE_BACKEND in the environment override path and backend
+CACHE_CONFIG = {
+    'path': "/var/lib/samen/cache.sqlite", # shared by every module on the box, see backends.SQLiteBackend
+    'backend': 'samen.sqlite', #or dogpile.cache.dbm
+    'expiration_time': 3600, #seconds an entry lives in the region
+    'memory_size': 10000, #entries held in the in-process tier
+    'memory_ttl': 60, #seconds an entry is served from memory before going back to the region
+}
 
-cache_path = "/var/lib/samen/cache.dbm"
+#background expiry and compaction of the sqlite file, started by MqttMessageHandler.start()
+SWEEP_POLICY = {
+    'interval': 60, #seconds between sweeps
+    'batch': 500, #rows deleted per statement
+    'max_bytes': 256 * 2**20, #size ceiling, rows closest to expiry go first when it is passed
+    'compact_every': 10, #sweeps between returning free pages to the filesystem
+}
 
-if not os.path.exists(os.path.dirname(cache_path)):
-    os.makedirs(os.path.dirname(cache_path))
+#counters kept per key namespace, the text before the first ':' of a key
+NAMESPACE_FIELDS = ('hits', 'misses', 'expirations', 'evictions', 'bytes_stored')
+DEFAULT_NAMESPACE = 'default' # keys without a ':'
 
-cache = make_region().configure(
-    'dogpile.cache.dbm',
-    expiration_time=3600,
-    arguments={'filename': cache_path}
-)
+
+#per namespace hits, misses, expirations, memory evictions and bytes written to the backend, and get/set latency
+#one lock covers the counters and both histograms so a get costs a single acquire
+class CacheMetrics:
+    def __init__(self) -> None:
+        self.namespaces = {}
+        self.get_latency, self.set_latency = Histogram(), Histogram()
+        self.lock = threading.Lock()
+
+    #counters of a key's namespace, call with the lock held
+    def counters(self, key):
+        namespace, colon, _ = key.partition(':')
+        if not colon:
+            namespace = DEFAULT_NAMESPACE
+        counters = self.namespaces.get(namespace)
+        if counters is None:
+            counters = self.namespaces[namespace] = dict.fromkeys(NAMESPACE_FIELDS, 0)
+        return counters
+
+    def count(self, key, field, amount=1):
+        with self.lock:
+            self.counters(key)[field] += amount
+
+    #a get of one key that took seconds and found the value or not
+    def got(self, key, hit, seconds):
+        with self.lock:
+            self.counters(key)['hits' if hit else 'misses'] += 1
+            self.get_latency.add(seconds)
+
+    def wrote(self, seconds):
+        with self.lock:
+            self.set_latency.add(seconds)
+
+    #on_write hook of the sqlite backend, called with the size of every row it writes
+    def stored(self, key, size):
+        self.count(key, 'bytes_stored', size)
+
+    def snapshot(self):
+        with self.lock:
+            namespaces = {namespace: dict(counters) for namespace, counters in self.namespaces.items()}
+        return {'namespaces': namespaces, 'latency': {'get': self.get_latency.snapshot(), 'set': self.set_latency.snapshot()}}
+
+
+#in-process lru in front of a dogpile region, reads go through to the region on a miss and writes go to both
+#values come back by reference from memory, so callers must not change them
+class TieredCache:
+    def __init__(self, region, size=10000, ttl=60, metrics=None) -> None:
+        self.region, self.size, self.ttl = region, size, ttl
+        self.metrics = CacheMetrics() if metrics is None else metrics
+        self.entries = OrderedDict() # key -> (expires at, value), oldest use first
+        self.hits = self.misses = self.l2_hits = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def remember(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + min(ttl or self.ttl, self.ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                evicted, _ = self.entries.popitem(last=False)
+                self.evictions += 1
+                self.metrics.count(evicted, 'evictions')
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+        return NO_VALUE
+
+    def get(self, key, expiration_time=None, ignore_expiration=False):
+        start = time.perf_counter()
+        value = self.lookup(key)
+        if value is NO_VALUE:
+            value = self.region.get(key, expiration_time=expiration_time, ignore_expiration=ignore_expiration)
+            if value is not NO_VALUE:
+                self.l2_hits += 1
+                self.remember(key, value, expiration_time)
+        self.metrics.got(key, value is not NO_VALUE, time.perf_counter() - start)
+        return value
+
+    def get_multi(self, keys, expiration_time=None, ignore_expiration=False):
+        start = time.perf_counter()
+        values = [self.lookup(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is NO_VALUE]
+        if missing:
+            found = dict(zip(missing, self.region.get_multi(missing, expiration_time=expiration_time, ignore_expiration=ignore_expiration)))
+            for key, value in found.items():
+                if value is not NO_VALUE:
+                    self.l2_hits += 1
+                    self.remember(key, value, expiration_time)
+            values = [found.get(key, value) if value is NO_VALUE else value for key, value in zip(keys, values)]
+        seconds = time.perf_counter() - start
+        with self.metrics.lock:
+            for key, value in zip(keys, values):
+                self.metrics.counters(key)['misses' if value is NO_VALUE else 'hits'] += 1
+            self.metrics.get_latency.add(seconds)
+        return values
+
+    def set(self, key, value, expiration_time=None):
+        start = time.perf_counter()
+        self.remember(key, value, expiration_time) # expiration_time only shortens the memory copy, the region keeps its own
+        self.region.set(key, value)
+        self.metrics.wrote(time.perf_counter() - start)
+
+    def set_multi(self, mapping):
+        start = time.perf_counter()
+        for key, value in mapping.items():
+            self.remember(key, value)
+        self.region.set_multi(mapping)
+        self.metrics.wrote(time.perf_counter() - start)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        self.region.delete(key)
+
+    def delete_multi(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+        self.region.delete_multi(keys)
+
+    #deletes an entry its owner found past its time, counted as an expiration
+    def expire(self, key):
+        self.delete(key)
+        self.metrics.count(key, 'expirations')
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'limit': self.size, 'hits': self.hits, 'misses': self.misses,
+                    'l2_hits': self.l2_hits, 'evictions': self.evictions, 'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+    def snapshot(self):
+        return {'memory': self.stats(), **self.metrics.snapshot()}
+
+
+_cache = _sweeper = None
+_lock = threading.Lock()
+
+
+#changes CACHE_CONFIG, only before the first get_cache()
+def configure(**changes):
+    with _lock:
+        if _cache is not None:
+            raise RuntimeError("the cache is already in use, configure it before the first get_cache()")
+        CACHE_CONFIG.update(changes)
+
+
+def settings():
+    config = dict(CACHE_CONFIG)
+    config['path'] = os.environ.get('SAMEN_CACHE_PATH', config['path'])
+    config['backend'] = os.environ.get('SAMEN_CACHE_BACKEND', config['backend'])
+    return config
+
+
+#the shared cache, built on first use
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                config = settings()
+                os.makedirs(os.path.dirname(config['path']) or '.', exist_ok=True)
+                metrics = CacheMetrics()
+                arguments = {'filename': config['path']}
+                if config['backend'] == 'samen.sqlite':
+                    arguments.update(expiration_time=config['expiration_time'], on_write=metrics.stored)
+                region = make_region().configure(config['backend'], expiration_time=config['expiration_time'], arguments=arguments)
+                _cache = TieredCache(region, size=config['memory_size'], ttl=config['memory_ttl'], metrics=metrics)
+    return _cache
+
+
+#the sweeper for the shared cache, None when its backend has nothing to sweep
+def get_sweeper():
+    global _sweeper
+    backend = get_cache().region.backend
+    with _lock:
+        if _sweeper is None and hasattr(backend, 'delete_expired'):
+            _sweeper = Sweeper(backend, **SWEEP_POLICY)
+    return _sweeper
+
+
+#counters, latency histograms and sweeper stats of the shared cache, for status reports
+#builds nothing, an empty dict until the cache is first used
+def snapshot():
+    if _cache is None:
+        return {}
+    result = _cache.snapshot()
+    if _sweeper is not None:
+        result['sweeper'] = _sweeper.stats()
+    return result
+
+
+#keeps `from essentials.cache import cache` working without building anything on import
+def __getattr__(name):
+    if name == 'cache':
+        return get_cache()
+    if name == 'sweeper':
+        return get_sweeper()
+    raise AttributeError(F"module {__name__!r} has no attribute {name!r}")
 
 # cache.set('my_key', 'my_value', expiration_time=60)
-# my_value = cache.get('my_key')
\ No newline at end of file
+# my_value = cache.get('my_key')
@@ -0,0 +1,284 @@
+##wire codecs for messages
+##json stays the default, the binary codec packs the MESSAGE_TEMPLATE fields in a fixed layout
+##the first byte of a payload says which codec wrote it, so modules on different codecs can talk:
+##  '{'  - json (what every module sent before codecs existed)
+##  0x01 - binary, see BinaryCodec
+##  0x02 - a batch of payloads from any of the above, see pack_batch
+##  0x03 - any of the above compressed with a preset dictionary, see Compressor
+
+import json, struct, zlib
+from .message import Message
+
+
+class JsonCodec:
+    name, magic = 'json', b'{'
+
+    def encode(self, message):
+        return message.to_wire().encode('utf-8')
+
+    def decode(self, payload):
+        return Message.from_wire(payload)
+
+
+#layout after the magic byte, all integers big endian:
+#  header    type code (B), flags (H), cache timeout (I), timestamp (d), re_timestamp (d)
+#  cache     stale and negative seconds of the cache attribute (II), only when the flag says so,
+#            or timeout, stale and negative (ddd) when one of them is not a whole number that fits in I
+#  id        16 raw bytes when it is 32 lowercase hex chars (flag), else length (H) + utf-8
+#  req_id    same as id, absent when empty
+#  key       same as id, absent when empty
+#  type      length (H) + utf-8, only when the type has no code
+#  from, to, data type    length (H) + utf-8 each
+#  message   the rest of the payload, utf-8 text or json when the flag says so,
+#            or the whole data dict as json when it holds more than message and type (flag)
+class BinaryCodec:
+    name, magic = 'binary', b'\x01'
+    header = struct.Struct('!BHIdd')
+    types = ('notice', 'request', 'response', 'error')
+    cache_extra = struct.Struct('!II')
+    cache_float = struct.Struct('!ddd')
+    length = struct.Struct('!H')
+    (CACHE, HEX_ID, HEX_REQ_ID, HAS_REQ_ID, JSON_DATA, HAS_TIMESTAMP, HAS_RE_TIMESTAMP, HAS_KEY, HEX_KEY, CACHE_EXTRA,
+     FULL_DATA, CACHE_FLOAT) = (1 << bit for bit in range(12))
+    CUSTOM_TYPE = 255
+
+    #only what comes back the same from bytes.hex(), uppercase or spaced hex would not round trip
+    @staticmethod
+    def is_hex(value):
+        if len(value) != 32:
+            return False
+        try:
+            return bytes.fromhex(value).hex() == value
+        except ValueError:
+            return False
+
+    @staticmethod
+    def whole(value):
+        return isinstance(value, int) and 0 <= value < 2**32
+
+    def encode(self, message):
+        flags = 0
+        cache_enabled, *numbers = message.cache
+        if cache_enabled:
+            flags |= self.CACHE
+        cache_timeout, stale, negative = ([number or 0 for number in numbers] + [0, 0, 0])[:3]
+        timestamp, re_timestamp = message.timestamp, message.re_timestamp
+        if timestamp != "":
+            flags |= self.HAS_TIMESTAMP
+        if re_timestamp != "":
+            flags |= self.HAS_RE_TIMESTAMP
+        parts = [self.magic, None]
+        if not (self.whole(cache_timeout) and self.whole(stale) and self.whole(negative)):
+            flags |= self.CACHE_FLOAT
+            parts.append(self.cache_float.pack(cache_timeout, stale, negative))
+            cache_timeout = 0
+        elif stale or negative:
+            flags |= self.CACHE_EXTRA
+            parts.append(self.cache_extra.pack(stale, negative))
+        for value, present, hex_flag in ((message.id, 0, self.HEX_ID), (message.req_id, self.HAS_REQ_ID, self.HEX_REQ_ID),
+                                         (message.key, self.HAS_KEY, self.HEX_KEY)):
+            if present and not value:
+                continue
+            flags |= present
+            if self.is_hex(value):
+                flags |= hex_flag
+                parts.append(bytes.fromhex(value))
+            else:
+                parts.append(self.text(value))
+        code = self.types.index(message.type) if message.type in self.types else self.CUSTOM_TYPE
+        if code == self.CUSTOM_TYPE:
+            parts.append(self.text(message.type))
+        data = message.data
+        data_type = data.get('type', "")
+        full = not isinstance(data_type, str) or 'type' not in data or data.keys() - {'message', 'type'}
+        for text in (message.sender, message.to, "" if full else data_type):
+            parts.append(self.text(text))
+        body = data if full else data.get('message', "")
+        if full:
+            flags |= self.FULL_DATA
+            body = json.dumps(body)
+        elif not isinstance(body, str):
+            flags |= self.JSON_DATA
+            body = json.dumps(body)
+        parts.append(body.encode('utf-8'))
+        parts[1] = self.header.pack(code, flags, cache_timeout, float(timestamp or 0), float(re_timestamp or 0))
+        return b''.join(parts)
+
+    @classmethod
+    def text(cls, value):
+        encoded = value.encode('utf-8')
+        return cls.length.pack(len(encoded)) + encoded
+
+    def decode(self, payload):
+        view = memoryview(payload)
+        code, flags, cache_timeout, timestamp, re_timestamp = self.header.unpack_from(view, 1)
+        offset = 1 + self.header.size
+        cache = (bool(flags & self.CACHE), cache_timeout)
+        if flags & self.CACHE_FLOAT:
+            cache_timeout, stale, negative = self.cache_float.unpack_from(view, offset)
+            offset += self.cache_float.size
+            cache = (cache[0], cache_timeout, stale, negative) if stale or negative else (cache[0], cache_timeout)
+        elif flags & self.CACHE_EXTRA:
+            cache += self.cache_extra.unpack_from(view, offset)
+            offset += self.cache_extra.size
+        if flags & self.HEX_ID:
+            id, offset = view[offset:offset + 16].hex(), offset + 16
+        else:
+            id, offset = self.read_text(view, offset)
+        req_id = ""
+        if flags & self.HAS_REQ_ID and flags & self.HEX_REQ_ID:
+            req_id, offset = view[offset:offset + 16].hex(), offset + 16
+        elif flags & self.HAS_REQ_ID:
+            req_id, offset = self.read_text(view, offset)
+        key = ""
+        if flags & self.HAS_KEY and flags & self.HEX_KEY:
+            key, offset = view[offset:offset + 16].hex(), offset + 16
+        elif flags & self.HAS_KEY:
+            key, offset = self.read_text(view, offset)
+        if code == self.CUSTOM_TYPE:
+            type, offset = self.read_text(view, offset)
+        else:
+            type = self.types[code]
+        sender, offset = self.read_text(view, offset)
+        to, offset = self.read_text(view, offset)
+        data_type, offset = self.read_text(view, offset)
+        body = str(view[offset:], 'utf-8')
+        if flags & self.FULL_DATA:
+            data = json.loads(body)
+        else:
+            data = {'message': json.loads(body) if flags & self.JSON_DATA else body, 'type': data_type}
+        return Message(id, type, sender, to, timestamp if flags & self.HAS_TIMESTAMP else "", data,
+                       req_id, re_timestamp if flags & self.HAS_RE_TIMESTAMP else "", cache, key)
+
+    @classmethod
+    def read_text(cls, view, offset):
+        length, = cls.length.unpack_from(view, offset)
+        offset += cls.length.size
+        if offset + length > len(view):
+            raise ValueError("truncated binary payload")
+        return str(view[offset:offset + length], 'utf-8'), offset + length
+
+
+BATCH_MAGIC = b'\x02'
+BATCH_HEADER = struct.Struct('!H')
+BATCH_ITEM = struct.Struct('!I')
+
+
+#wraps encoded payloads in one envelope: magic, count (H), then length (I) + payload for each
+def pack_batch(payloads):
+    parts = [BATCH_MAGIC, BATCH_HEADER.pack(len(payloads))]
+    for payload in payloads:
+        parts.append(BATCH_ITEM.pack(len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def unpack_batch(payload):
+    view = memoryview(payload)
+    count, = BATCH_HEADER.unpack_from(view, 1)
+    offset, payloads = 1 + BATCH_HEADER.size, []
+    for _ in range(count):
+        length, = BATCH_ITEM.unpack_from(view, offset)
+        offset += BATCH_ITEM.size
+        payloads.append(bytes(view[offset:offset + length]))
+        offset += length
+    return payloads
+
+
+COMPRESSED_MAGIC = b'\x03'
+MAX_DECOMPRESSED = 64 * 2**20 # a payload that inflates past this is refused
+
+#preset dictionaries by id, deflate can refer back into one from the first byte of a payload so the envelope
+#keys and usual values cost a few bits each. ids are never reused, a new dictionary gets the next id and
+#receivers must know it before senders use it. the most common strings go last, they are the cheapest to refer to
+ZDICTS = {
+    1: (b'"stream-open" "stream-ready" "stream-chunk" "stream-ack" "metrics" "image" "video" "audio" "file" "crc": "seq": '
+        b'"transfer": "next": "done": false, "error": null, "samen_messages_published_total" "quantiles": "count": "sum": '
+        b'{"id": "", "type": "notice", "from": "", "to": "all", "timestamp": 17, "data": {"message": "connected", "type": "text"}, '
+        b'"req_id": "", "re_timestamp": "", "cache": [false, 0], "key": ""}'
+        b'{"id": "", "type": "error", "from": "", "to": "", "timestamp": 17, "data": {"message": "busy", "type": "text"}, '
+        b'"req_id": "", "re_timestamp": 17, "cache": [false, 0], "key": ""}'
+        b'{"id": "", "type": "request", "from": "", "to": "", "timestamp": 17, "data": {"message": {"": ""}, "type": "json"}, '
+        b'"req_id": "", "re_timestamp": "", "cache": [true, 60], "key": ""}'
+        b'{"id": "", "type": "response", "from": "", "to": "", "timestamp": 17, "data": {"message": "", "type": "text"}, '
+        b'"req_id": "", "re_timestamp": 17, "cache": [false, 0], "key": ""}'),
+}
+
+
+#compresses payloads of at least `threshold` bytes: magic, dictionary id (B), raw deflate of the payload
+#a payload that would not get smaller is sent as it is
+class Compressor:
+    def __init__(self, threshold=512, level=6, dictionary=1) -> None:
+        self.threshold, self.dictionary = threshold, dictionary
+        self.header = COMPRESSED_MAGIC + bytes((dictionary, ))
+        # a 4k window and small hash tables: messages are short, and copy() below copies all of that state per payload
+        self.template = zlib.compressobj(level, zlib.DEFLATED, -12, 4, zlib.Z_DEFAULT_STRATEGY, ZDICTS[dictionary])
+        self.compressed = self.bytes_in = self.bytes_out = 0
+
+    def compress(self, payload):
+        if len(payload) < self.threshold:
+            return payload
+        compressor = self.template.copy() # the dictionary is loaded once, not per payload
+        body = compressor.compress(payload) + compressor.flush()
+        if len(body) + len(self.header) >= len(payload):
+            return payload
+        self.compressed += 1
+        self.bytes_in += len(payload)
+        self.bytes_out += len(body) + len(self.header)
+        return self.header + body
+
+    def stats(self):
+        return {'compressed': self.compressed, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'ratio': self.bytes_out / self.bytes_in if self.bytes_in else 1.0}
+
+
+_decompressors = {} # dictionary id -> primed decompressobj to copy
+
+
+def decompress(payload):
+    dictionary = payload[1]
+    template = _decompressors.get(dictionary)
+    if template is None:
+        if dictionary not in ZDICTS:
+            raise ValueError(F"payload compressed with unknown dictionary {dictionary}")
+        template = _decompressors[dictionary] = zlib.decompressobj(-15, zdict=ZDICTS[dictionary]) # the largest window reads any
+    decompressor = template.copy()
+    data = decompressor.decompress(memoryview(payload)[2:], MAX_DECOMPRESSED)
+    if decompressor.unconsumed_tail:
+        raise ValueError(F"compressed payload inflates past {MAX_DECOMPRESSED} bytes")
+    return data + decompressor.flush()
+
+
+#what decoding a truncated, corrupt or unknown frame raises, ValueError covers json and utf-8 errors
+DECODE_ERRORS = (ValueError, struct.error, zlib.error, KeyError, TypeError, IndexError)
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), BinaryCodec())}
+BY_MAGIC = {codec.magic[0]: codec for codec in CODECS.values()}
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(F"unknown codec {name}, expected one of {list(CODECS)}") from None
+
+
+#decodes a payload written by any known codec
+def decode_payload(payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    codec = BY_MAGIC.get(payload[0]) if payload else None
+    if codec is None: # json that starts with whitespace or anything else unknown
+        codec = CODECS['json']
+    return codec.decode(payload)
+
+
+#every message in a payload, a batch envelope gives several
+def decode_messages(payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if payload[:1] == COMPRESSED_MAGIC: # compression wraps the whole frame, batch or single message
+        payload = decompress(payload)
+    if payload[:1] == BATCH_MAGIC:
+        return [decode_payload(item) for item in unpack_batch(payload)]
+    return [decode_payload(payload)]
@@ -0,0 +1,41 @@
+##drops messages that were already received within a time window
+##keys go into a ring of time buckets, the oldest bucket is cleared as time moves on,
+##each bucket holds at most max_entries / buckets hashes so memory stays flat whatever the rate
+
+import threading, time
+
+
+class DedupWindow:
+    def __init__(self, window=30, buckets=6, max_entries=300000) -> None:
+        self.span = window / buckets # seconds covered by one bucket
+        self.buckets = [set() for _ in range(buckets)]
+        self.epochs = [None] * buckets # which span each bucket currently holds
+        self.capacity = max_entries // buckets
+        self.hits = self.misses = self.overflows = 0
+        self.lock = threading.Lock()
+
+    #true if key was seen within the window, otherwise remembers it
+    def seen(self, key, now=None):
+        digest = hash(key) # an int per key instead of the tuple keeps the buckets small
+        epoch = int((now or time.monotonic()) / self.span)
+        index = epoch % len(self.buckets)
+        with self.lock:
+            if self.epochs[index] != epoch: # this bucket last held a span that is out of the window
+                self.buckets[index].clear()
+                self.epochs[index] = epoch
+            for bucket_epoch, bucket in zip(self.epochs, self.buckets):
+                if bucket_epoch is not None and epoch - bucket_epoch < len(self.buckets) and digest in bucket:
+                    self.hits += 1
+                    return True
+            self.misses += 1
+            bucket = self.buckets[index]
+            if len(bucket) < self.capacity:
+                bucket.add(digest)
+            else: # past the memory bound, the key is let through without being remembered
+                self.overflows += 1
+        return False
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'overflows': self.overflows,
+                    'entries': sum(len(bucket) for bucket in self.buckets)}
@@ -0,0 +1,138 @@
+##hands received messages to a pool of worker threads so handlers never run on the paho network thread
+##every message type gets its own bounded queue, when one is full the overflow policy decides:
+##  block       - the network thread waits for room
+##  drop_oldest - the oldest queued message of that type is dropped
+##  reject      - the new message is refused, requests get an error response through on_reject
+##messages with the same key (the sending module by default) run one at a time in arrival order,
+##different keys run in parallel across the workers
+
+import threading, logging
+from collections import deque
+
+log = logging.getLogger('samen.dispatch')
+
+QUEUE_TYPES = ('response', 'request', 'notice') # workers drain in this order, responses unblock waiting requests
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'reject')
+QUEUE_OF = {'error': 'response'} # an error answers a request just as a response does, other unknown types are notices
+
+
+class Dispatcher:
+    # key is a message field name or a function of the message, None disables ordering
+    def __init__(self, handler, workers=4, queue_size=1000, overflow='block', key='from', on_reject=None) -> None:
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(F"overflow must be one of {OVERFLOW_POLICIES}, got {overflow}")
+        self.handler, self.workers, self.overflow, self.on_reject = handler, workers, overflow, on_reject
+        if callable(key) or key is None:
+            self.key = key or (lambda message: None)
+        else:
+            self.key = lambda message: message.get(key)
+        sizes = queue_size if isinstance(queue_size, dict) else dict.fromkeys(QUEUE_TYPES, queue_size)
+        self.queues = {kind: deque() for kind in QUEUE_TYPES}
+        self.sizes = {kind: sizes.get(kind, 1000) for kind in QUEUE_TYPES}
+        self.counts = dict.fromkeys(QUEUE_TYPES, 0) # queued per type, including messages held behind a busy key
+        self.busy = {} # key -> messages waiting for the one of that key already queued or running
+        self.dropped = dict.fromkeys(QUEUE_TYPES, 0)
+        self.rejected = dict.fromkeys(QUEUE_TYPES, 0)
+        self.condition = threading.Condition()
+        self.threads = []
+        self.running = False
+
+    def kind(self, message):
+        kind = message.get('type')
+        kind = QUEUE_OF.get(kind, kind)
+        return kind if kind in self.queues else 'notice'
+
+    #queue a decoded message, returns False if it was dropped or rejected
+    def submit(self, message):
+        kind = self.kind(message)
+        accepted = True
+        with self.condition:
+            if self.counts[kind] >= self.sizes[kind]:
+                if self.overflow == 'block':
+                    self.condition.wait_for(lambda: self.counts[kind] < self.sizes[kind] or not self.running)
+                elif self.overflow == 'drop_oldest' and self.queues[kind]:
+                    successor = self.release(self.queues[kind].popleft())
+                    if successor is not None: # the dropped message's key passes on to the next in line
+                        self.queues[self.kind(successor)].appendleft(successor)
+                    self.counts[kind] -= 1
+                    self.dropped[kind] += 1
+                elif self.overflow == 'drop_oldest': # everything of this type is held behind busy keys
+                    self.dropped[kind] += 1
+                    return False
+                else:
+                    self.rejected[kind] += 1
+                    accepted = False
+            if accepted:
+                key = self.key(message)
+                if key is not None and key in self.busy:
+                    self.busy[key].append(message)
+                else:
+                    if key is not None:
+                        self.busy[key] = deque()
+                    self.queues[kind].append(message)
+                self.counts[kind] += 1
+                self.condition.notify_all()
+        if not accepted and self.on_reject:
+            self.on_reject(message)
+        return accepted
+
+    #hands the key of a finished or dropped message to the next message of that key, call with the lock held
+    def release(self, message):
+        key = self.key(message)
+        if key is None or key not in self.busy:
+            return None
+        if self.busy[key]:
+            return self.busy[key].popleft()
+        del self.busy[key]
+        return None
+
+    #queued messages per type
+    def depth(self):
+        with self.condition:
+            return dict(self.counts)
+
+    def stats(self):
+        with self.condition:
+            return {'depth': dict(self.counts), 'busy_keys': len(self.busy), 'dropped': dict(self.dropped), 'rejected': dict(self.rejected)}
+
+    #next message for a worker, the successor of the message it just finished comes first
+    def next_message(self, finished=None):
+        with self.condition:
+            message = self.release(finished) if finished is not None else None
+            while message is None and self.running:
+                for queue in self.queues.values():
+                    if queue:
+                        message = queue.popleft()
+                        break
+                else:
+                    self.condition.wait()
+            if message is not None:
+                self.counts[self.kind(message)] -= 1
+                self.condition.notify_all() # wake a blocked submit
+            return message if self.running else None
+
+    def work(self):
+        message = None
+        while True:
+            message = self.next_message(message)
+            if message is None:
+                return
+            try:
+                self.handler(message)
+            except Exception: # one bad handler must not take a worker down
+                log.exception("handler failed for %s", message.get('id'))
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    #stops the workers, whatever is still queued is discarded
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
@@ -0,0 +1,37 @@
+##message ids and cache keys
+##an id names one message: 128 bits as 32 hex chars, milliseconds since the epoch (48 bits),
+##a wrapping counter (16 bits) and a random node id per process (64 bits), so ids sort by creation time
+##a cache key names the content of a message and where it goes, identical data to the same module gives the same key
+
+import os, time, json, hashlib, itertools
+
+node = os.urandom(8).hex()
+counter = itertools.count()
+
+
+#forked children must not hand out the parent's ids
+def reset_node():
+    global node, counter
+    node, counter = os.urandom(8).hex(), itertools.count()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_node)
+
+
+def new_id():
+    return F"{time.time_ns() // 1000000:012x}{next(counter) & 0xffff:04x}{node}"
+
+
+#milliseconds since the epoch an id was made at
+def id_time(message_id):
+    return int(message_id[:12], 16)
+
+
+#key of the data of a message and its destination, only computed when the message asks to be cached
+#the cache is shared by every module on the box, the same request to two modules must not share an answer
+def content_key(data, to=""):
+    body = data['message']
+    if not isinstance(body, str):
+        body = json.dumps(body, sort_keys=True)
+    return hashlib.blake2b(F"{to}\0{data.get('type', '')}\0{body}".encode('utf-8'), digest_size=16).hexdigest()
@@ -4,11 +4,27 @@
 ## use as much async as possible
 
 import paho.mqtt.client as mqtt
-import json, time, argparse, hashlib
-from cache import cache as ch
+import time, argparse, asyncio, inspect, threading, logging
+from collections import OrderedDict
+from concurrent.futures import Future
+from .cache import get_cache, get_sweeper, snapshot as cache_snapshot
+from .pending import PendingRequests
+from .timers import TimingWheel
+from .dispatch import Dispatcher
+from .message import Message
+from .ids import content_key
+from .codec import get_codec, decode_messages, Compressor, DECODE_ERRORS
+from .batching import Batcher
+from .dedup import DedupWindow
+from .metrics import MetricsRegistry
+from .routing import Router
+from .transport import LocalTransport
+from . import logs
+from .logs import MessageLog
 
+#wire format of a message, build messages with Message rather than filling this in
 MESSAGE_TEMPLATE = {
-    "id": "",   #unique id for the message set to the hash of the json string of data encoded as utf-8 ""
+    "id": "",   #unique, time ordered id of the message, see ids.new_id
     "type": "", #type of the message [notice, request, response, error]
     "from": "", #id of the sending module
     "to": "all",   #id of the receiving module
@@ -18,7 +34,8 @@ MESSAGE_TEMPLATE = {
         'type': "", #type of data [text, image, video, audio, file, json]
     }, 'req_id': "", #id of the request if the message is a response
     're_timestamp': "", #timestamp of the request if the message is a response
-    "cache":[False, 0], #whether to cache the message or not
+    "cache":[False, 0], #[enabled, timeout] and optionally [.., stale, negative], see cache_settings
+    "key": "", #hash of data when caching is asked for, responses carry the key of their request
     }
 
 BROKER_DATA = {
@@ -28,10 +45,170 @@ BROKER_DATA = {
     'timeout':3600, "client_id": "testout"
 }
 
+#the broker of essentials.broker on this machine, plain tcp and no login, for tests and benchmarks
+LOCAL_BROKER_DATA = dict(BROKER_DATA, username="", password="", address='127.0.0.1', mqtt_port=1883, use_websockets=False, tls=False)
+
+#first and longest wait between attempts to reconnect to the broker, the wait doubles after each failure
+RECONNECT_DELAY = {'min_delay': 1, 'max_delay': 60}
+
+REQUEST_POLICY = {
+    'timeout': 10, #seconds to wait for a response before the first resend
+    'retries': 5, #resends before the request fails
+    'backoff': 2, #each resend waits backoff times longer than the last
+    'max_delay': 60, #cap on the wait between resends
+    'tick': 0.1, #resolution of the timing wheel driving resends and cache expiry
+}
+
+DISPATCH_POLICY = {
+    'workers': 4, #threads running the handlers
+    'queue_size': 1000, #per message type, or a dict of {type: size}
+    'overflow': 'block', #what to do when a queue is full [block, drop_oldest, reject]
+    'key': 'from', #messages with the same key are handled in order, a field name or function of the message
+}
+
+#qos and retain per message, looked up by (type, data type), then (type, None), (None, data type), then (None, None)
+#requests can go at qos 1 because duplicates are dropped on receive (see DEDUP_POLICY)
+QOS_POLICY = {
+    ('notice', None): (0, False),
+    ('request', None): (1, False),
+    ('response', None): (1, False),
+    ('error', None): (1, False),
+    ('notice', 'stream-chunk'): (1, False), #a lost chunk costs the rest of its window, see streaming.py
+    ('notice', 'stream-ack'): (1, False),
+    (None, None): (2, False),
+}
+
+#messages with a (from, id, timestamp) already received within the window are dropped on receive
+DEDUP_POLICY = {
+    'window': 30, #seconds a message is remembered
+    'buckets': 6, #the window moves in steps of window / buckets
+    'max_entries': 300000, #memory bound, enough for 10k msg/s over the window
+    'answers': 10000, #responses kept to answer resent requests, checked for every request whatever the window
+}
+
+#opt-in, pass as batching= to coalesce small messages per topic. delays are rounded up to the request policy tick
+BATCH_POLICY = {
+    'notice': {'size': 50, 'delay': 0.1}, #send after 50 messages or once the oldest has waited 0.1s
+    'response': {'size': 20, 'delay': 0.1},
+}
+
+#data types whose identical requests share one round trip: a request with the same content and destination as one
+#still waiting for its response is not sent, its caller gets the outstanding request's future. opt-in, e.g. ('json', )
+#only list types whose requests have no side effects, the handler on the other end runs once for all of them
+COALESCE_POLICY = ()
+
+#the handler's metrics are published as a json notice with data type 'metrics' every interval seconds, 0 turns it off
+#metrics_text() gives the same figures in the prometheus text format
+METRICS_POLICY = {
+    'interval': 60,
+}
+
+
+#the cache attribute of a message as (enabled, timeout, stale, negative), the last two are optional on the wire
+#  timeout  - seconds a cached response is served as is
+#  stale    - seconds past the timeout it is still served while a fresh one is fetched behind it
+#  negative - seconds an error response is cached so a failing module is not asked again, 0 leaves errors uncached
+def cache_settings(cache):
+    enabled, timeout, stale, negative = (*cache, 0, 0)[:4]
+    return enabled, timeout or 0, stale or 0, negative or 0
+
+
+#opt-in, pass as compression= to deflate payloads of at least threshold bytes with a preset dictionary (codec.ZDICTS)
+#applies to the frame that is published, a batch is compressed as a whole. every module decodes it whatever it sends
+COMPRESSION_POLICY = {
+    'threshold': 512, #bytes, smaller payloads gain little and cost the same cpu per call
+    'level': 6,
+    'dictionary': 1,
+}
+
+#opt-in, pass as local= to send messages addressed to one module on this host over a unix socket instead of the broker
+#broadcasts and modules without a socket in the directory go through mqtt as before
+LOCAL_POLICY = {
+    'directory': "/run/samen", #every module on the host must use the same one
+    'max_payload': 65536, #bytes, larger payloads go through the broker
+    'retry_after': 5, #seconds a module that was not found is left to mqtt before trying its socket again
+}
+
+#opt-in, pass as routing= to send every message on <prefix>/<to>/<type> instead of the publish_to topics
+#and have paho route what is addressed to this module without decoding it. every module of a deployment
+#has to turn it on together, the subscribe_to topics are still listened on
+ROUTING_POLICY = {
+    'prefix': 'samen',
+}
+
+#messages are logged as json lines by a background writer (see logs.py), handled messages at debug, default handlers at info
+LOG_POLICY = {
+    'level': 'INFO',
+    'envelope_only': False, #leave the data out of logged messages
+    'sample': {}, #fraction of the messages of a type that is logged, e.g. {'notice': 0.1}, unlisted types are all logged
+    'rate': {None: 1000}, #most messages of a type logged per second, None for every type not listed
+    'output': 'stdout', #where start() points the writer, None leaves logging to the application's config
+}
+
+
+#picks qos and retain for a message from a QOS_POLICY style table
+class QosPolicy:
+    def __init__(self, table=QOS_POLICY) -> None:
+        self.table = table
+        self.resolved = {} # (type, data type) -> (qos, retain), filled on first use
+
+    def lookup(self, message):
+        key = (message['type'], message['data'].get('type'))
+        found = self.resolved.get(key)
+        if found is None:
+            kind, data_type = key
+            for candidate in (key, (kind, None), (None, data_type), (None, None)):
+                if candidate in self.table:
+                    found = self.table[candidate]
+                    break
+            else:
+                found = (2, False)
+            self.resolved[key] = found
+        return found
+
 
 class MqttMessageHandler:
     # initializes the client
-    def __init__(self, broker_data=BROKER_DATA, call_backs={}, handlers={}, my_id="") -> None:
+    def __init__(self, broker_data=BROKER_DATA, call_backs={}, handlers={}, my_id="", request_policy=REQUEST_POLICY, dispatch=DISPATCH_POLICY, codec='json', batching=None, qos_policy=QOS_POLICY, dedup=DEDUP_POLICY, coalesce=COALESCE_POLICY, metrics=METRICS_POLICY, logging_policy=LOG_POLICY, routing=None, compression=None, local=None) -> None:
+        self.qos = QosPolicy(qos_policy)
+        self.local = LocalTransport(broker_data['client_id'], **local) if local and broker_data else None
+        self.compressor = Compressor(**compression) if compression else None
+        self.router = Router(broker_data['client_id'], **routing) if routing and broker_data else None
+        self.coalesce = frozenset(coalesce)
+        dedup = dict(dedup or {})
+        self.answers_limit = dedup.pop('answers', DEDUP_POLICY['answers'])
+        self.dedup = DedupWindow(**dedup) if dedup else None
+        self.answers = OrderedDict() # (from, id, timestamp) of recent requests -> our response, for repeats of the request
+        self.answers_lock = threading.Lock()
+        self.codec = get_codec(codec) # what we send with, anything known is accepted on receive
+        policy = dict(request_policy)
+        self.tick_interval = policy.pop('tick', REQUEST_POLICY['tick'])
+        self.timers = TimingWheel(tick=self.tick_interval)
+        self.pending = PendingRequests(resend=self.resend_request, wheel=self.timers, future_factory=self.new_future, **policy)
+        self.ticker = None
+        self.batcher = Batcher(self.publish_payload, self.timers, batching) if batching else None
+        self.dispatcher = Dispatcher(self.process_message, on_reject=self.reject_message, **dispatch) if dispatch else None
+        self.report_interval = metrics.get('interval', 0) if metrics else 0
+        self.metrics = MetricsRegistry()
+        self.published = self.metrics.counter('samen_messages_published_total', "messages handed to paho, one per topic")
+        self.received = self.metrics.counter('samen_messages_received_total', "messages decoded from incoming payloads")
+        self.reconnects = self.metrics.counter('samen_reconnects_total', "connections to the broker after the first")
+        self.published_local = self.metrics.counter('samen_messages_published_local_total', "messages sent over the same host transport")
+        self.dropped_topic = self.metrics.counter('samen_messages_dropped_total', "messages dropped before handling, by reason", reason='topic')
+        self.dropped_address = self.metrics.counter('samen_messages_dropped_total', "messages dropped before handling, by reason", reason='address')
+        self.dropped_decode = self.metrics.counter('samen_messages_dropped_total', "messages dropped before handling, by reason", reason='decode')
+        self.metrics.gauge('samen_requests_in_flight', lambda: len(self.pending), "requests waiting for a response")
+        self.metrics.gauge('samen_mqtt_out_packets', lambda: len(getattr(self.client, '_out_packet', ())), "packets queued in paho for the socket")
+        self.metrics.gauge('samen_mqtt_out_messages', lambda: len(getattr(self.client, '_out_messages', ())), "publishes paho holds until the broker acknowledges them")
+        if self.compressor:
+            self.metrics.gauge('samen_compression_bytes_saved', lambda: self.compressor.bytes_in - self.compressor.bytes_out,
+                               "bytes compression kept off the wire")
+        self.connections = 0
+        self.streams = None # set by streaming.Streams, takes the stream messages off the normal path
+        self.logging_policy = logging_policy
+        self.log = MessageLog(logs.logger.getChild('intercom'), envelope_only=logging_policy.get('envelope_only', False),
+                              sample=logging_policy.get('sample'), rate=logging_policy.get('rate'),
+                              dropped=self.metrics.counter('samen_log_dropped_total', "messages sampling and rate limits kept out of the log"))
         if broker_data:
             self.broker_data = broker_data
             self.client = self.get_client(broker_data=broker_data)
@@ -48,118 +225,322 @@ class MqttMessageHandler:
         self.response_handler = handlers.get('response', self.printboy)
 
     def printboy(self, message):
-        print(F"Got message: {message}")
+        self.log.message(logging.INFO, "got message", message)
 
-    #returns a client instance
-    def get_client(self, broker_data=None, clean_session=True):
+    #returns a client instance, connect=False leaves connecting to the caller
+    def get_client(self, broker_data=None, clean_session=True, connect=True):
         resp = False
         if broker_data: # Create a client instance
             client = mqtt.Client(client_id=broker_data['client_id'])  # Replace with your desired client_id
-            client.username_pw_set(broker_data['username'], broker_data['password'])# Set credentials
+            if broker_data.get('username'):
+                client.username_pw_set(broker_data['username'], broker_data['password'])# Set credentials
             client.on_connect = self.on_connect # Assign the callbacks to the client
             client.on_message = self.on_message # Assign the callbacks to the client
             client.on_disconnect = self.on_disconnect # Assign the callbacks to the client
-            client.reconnect_delay_set(min_delay=1, max_delay=60) #automatically reconnect after 1 second and increase the delay to 60 seconds
-            while True:
+            if self.router:
+                for topic_filter in self.router.filters(): # routed before on_message, by topic alone
+                    client.message_callback_add(topic_filter, self.on_routed_message)
+            client.reconnect_delay_set(**RECONNECT_DELAY) #automatically reconnect after 1 second and increase the delay to 60 seconds
+            if broker_data['use_websockets']:# Configure MQTT broker using WebSockets
+                client.ws_set_options(path="/mqtt")
+            elif broker_data.get('tls', True):# Configure MQTT broker using SSL/TLS
+                client.tls_set()
+            while connect:
                 try:
-                    if broker_data['use_websockets']:# Configure MQTT broker using WebSockets
-                        client.ws_set_options(path="/mqtt")
-                        port = broker_data['ws_port']
-                    else:# Configure MQTT broker using SSL/TLS
-                        client.tls_set()
-                        port = broker_data['mqtt_port']
-                    client.connect(broker_data['address'], port, keepalive=broker_data['timeout']) # Connect to MQTT broker
+                    self.connect_client(client, broker_data)
                     break
                 except KeyboardInterrupt:# Disconnect and stop the network loop when manually interrupted
                     client.disconnect()
             resp = client
         return resp
+
+    #connects a client returned by get_client to the broker
+    def connect_client(self, client, broker_data):
+        port = broker_data['ws_port'] if broker_data['use_websockets'] else broker_data['mqtt_port']
+        client.connect(broker_data['address'], port, keepalive=broker_data['timeout']) # Connect to MQTT broker
     
     #notifies connetion to subscribers.
     def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.connections += 1
+            if self.connections > 1:
+                self.reconnects.inc()
         if self.broker_data and rc == 0:
-            self.subscribe_to_topics(self.broker_data['subscribe_to'])
+            self.subscribe_to_topics(self.broker_data['subscribe_to'] + (self.router.filters() if self.router else []))
             message = self.prepare_message(message_data={'message':'connected', 'data_type':'text', 'type':'notice'}, cache=[False, 0])
             self.publish_to_topics(self.broker_data['publish_to'], message)
 
     def on_disconnect(self, client, userdata, rc):
         pass
     
-    # function to cache a response
-    def cache_message(self, message, data=None):
-        can_cache, timeout = message['cache']  # check if we can cache the message (responses can be cached)
-        if can_cache and timeout: #check if cache is enabled
+    # function to cache a response, cached under the content key of the request so an identical request finds it
+    # errors are cached for the negative time, a response past its timeout is still returned within the stale time
+    # and refresh=True sends the request again behind it
+    def cache_message(self, message, data=None, refresh=False):
+        can_cache, timeout, stale, negative = cache_settings(message['cache'])  # check if we can cache the message (responses can be cached)
+        if can_cache and (timeout or negative) and message['key']: #check if cache is enabled
+            ch = get_cache()
             if message['type'] == 'response': # if cache response
-                ch.set(message['req_id'], {'value': message, 'timestamp': time.time(), 'timeout': timeout})
-            data = ch.get(message['id']) # get the cached message
+                if timeout:
+                    self.store_cached(message, timeout, stale)
+            elif message['type'] == 'error':
+                cached = ch.get(self.cache_key(message))
+                if negative and not (cached and cached['value']['type'] == 'response'): # a stale response beats an error
+                    self.store_cached(message, negative, 0)
+            else:
+                data = ch.get(self.cache_key(message)) # get the cached message
         if data: # timeout checker
-            if time.time() - data['timestamp'] > data['timeout']:
-                ch.delete(message['id'])
+            age = time.time() - data['timestamp']
+            if age > data['timeout'] + data.get('stale', 0):
+                get_cache().expire(self.cache_key(message))
                 data = None
             else:
+                if age > data['timeout'] and refresh:
+                    self.refresh_cached(message)
                 data = data['value']
         return (data, message)
 
+    #messages are cached in the 'intercom' namespace of the shared cache, see cache.CacheMetrics
+    def cache_key(self, message):
+        return F"intercom:{message['key']}"
+
+    def store_cached(self, message, timeout, stale):
+        entry = {'value': message, 'timestamp': time.time(), 'timeout': timeout, 'stale': stale}
+        get_cache().set(self.cache_key(message), entry)
+        self.timers.schedule(timeout + stale, self.expire_cached, self.cache_key(message), entry['timestamp']) # drop it even if nobody reads it again
+
+    #drops a cached entry unless it was replaced since the timer was set
+    def expire_cached(self, key, timestamp):
+        ch = get_cache()
+        data = ch.get(key)
+        if data and data['timestamp'] == timestamp:
+            ch.expire(key)
+
+    #sends a request whose cached response went stale, one refresh per key at a time
+    #the response is cached by process_message like any other
+    def refresh_cached(self, request):
+        future, is_new = self.pending.add(request, callback=self.refreshed, key=(request['to'], request['key']))
+        if is_new:
+            self.publish_to_topics(self.broker_data['publish_to'], request)
+
+    #nobody waits on a refresh, a failed one just leaves the stale response until it runs out
+    def refreshed(self, future):
+        if not future.cancelled():
+            future.exception()
+
     
-    # handles all the messages received
+    # handles all the messages received, the cache lookup and handlers run on the dispatcher workers
     def on_message(self, client, userdata, msg):
-        response, message = self.cache_message(json.loads(msg.payload))
+        if self.router and self.router.routed(msg.topic) and not self.router.accepts(msg.topic):
+            self.dropped_topic.inc() # routed to another module, nothing decoded
+            return
+        self.receive(msg.payload)
+
+    #messages on our routed topics, paho picked them by topic so they are all for us
+    def on_routed_message(self, client, userdata, msg):
+        self.receive(msg.payload)
+
+    def receive(self, payload):
+        me = self.broker_data['client_id']
+        try:
+            messages = decode_messages(payload) # a batch envelope holds several
+        except DECODE_ERRORS as e: # raising here would end paho's network thread
+            self.dropped_decode.inc()
+            self.log.log.warning("dropped a payload that does not decode: %r, %r", bytes(payload[:64]), e)
+            return
+        for message in messages:
+            self.received.inc()
+            try: # dedup, the answer table and the dispatch queues hash these, a list or object in one would raise
+                hash((message['from'], message['id'], message['timestamp'], message['type'], message['to']))
+            except TypeError:
+                self.dropped_decode.inc()
+                self.log.log.warning("dropped a message with unhashable envelope fields: %r", message.to_dict())
+                continue
+            if message['to'] not in ('all', me):
+                self.dropped_address.inc()
+                continue
+            # resends go on for longer than the dedup window, so answers are checked for every request
+            if message['type'] == 'request' and self.answer_again(message):
+                continue
+            if self.dedup and self.dedup.seen((message['from'], message['id'], message['timestamp'])):
+                continue
+            if self.dispatcher:
+                self.dispatcher.submit(message)
+            else:
+                self.process_message(message)
+
+    #a repeated request gets the response we already sent instead of running the handler again, True if it did
+    def answer_again(self, request):
+        with self.answers_lock:
+            response = self.answers.get((request['from'], request['id'], request['timestamp']))
+        if response is None:
+            return False
+        self.publish_to_topics(self.broker_data['publish_to'], response)
+        return True
+
+    def process_message(self, message):
+        if self.streams and self.streams.handle(message):
+            return
+        response, message = self.cache_message(message)
         if response:
             pass
         self.handle_message(message, skip=False)
+
+    #answers a request the dispatcher had no room for with an error response
+    def reject_message(self, message):
+        if message['type'] == 'request':
+            error = Message.response(message, self.broker_data['client_id'], 'busy', 'text', type='error')
+            self.publish_to_topics(self.broker_data['publish_to'], error)
     
     #subscribes to all the topics
     def subscribe_to_topics(self, topics):
         for topic in topics:
             self.client.subscribe(topic)
 
-    #publishes to all the topics
-    def publish_to_topics(self, topics, message):
+    #publishes to all the topics, qos and retain come from the qos policy unless given
+    def publish_to_topics(self, topics, message, qos=None, retain=None):
+        if self.router:
+            topics = (self.router.topic(message), )
+        policy_qos, policy_retain = self.qos.lookup(message)
+        qos, retain = policy_qos if qos is None else qos, policy_retain if retain is None else retain
+        payload = self.codec.encode(message)
+        if self.local and message['to'] != 'all' and self.local.send(message['to'], payload):
+            self.published_local.inc()
+            return
+        self.published.inc(len(topics))
         for topic in topics:
-            self.client.publish(topic, payload=json.dumps(message), qos=2, retain=False)
+            if not (self.batcher and self.batcher.add(topic, message, payload, qos, retain)):
+                self.publish_payload(topic, payload, qos, retain)
+
+    def publish_payload(self, topic, payload, qos=2, retain=False):
+        if self.compressor:
+            payload = self.compressor.compress(payload)
+        self.client.publish(topic, payload=payload, qos=qos, retain=retain)
+
+    #points the log at its output, shared by every handler in the process
+    def start_logging(self):
+        if self.logging_policy.get('output') == 'stdout':
+            logs.start(level=self.logging_policy.get('level', 'INFO'))
 
     #starts the client
     def start(self):
         if self.client:
-            print(F"starting client {self.client}")
+            self.start_logging()
+            self.log.log.info("starting client %s", self.broker_data['client_id'])
+            if self.dispatcher:
+                self.dispatcher.start()
+            if self.local:
+                self.local.start(self.receive)
+            self.start_sweeper()
             self.client.loop_start()
+            self.ticker = threading.Event()
+            threading.Thread(target=self.tick_loop, args=(self.ticker,), daemon=True).start()
+            if self.report_interval:
+                self.timers.schedule(self.report_interval, self.report_metrics)
 
     #stops the client
     def stop(self):
+        if self.batcher: # before the loop stops so the held messages still go out
+            self.batcher.flush()
         if self.client:
             self.client.loop_stop()
+        if self.dispatcher:
+            self.dispatcher.stop()
+        if self.local:
+            self.local.stop()
+        if self.ticker:
+            self.ticker.set()
+        self.pending.cancel()
+
+    #the cache sweeper is shared by every handler in the process, starting it again does nothing
+    def start_sweeper(self):
+        sweeper = get_sweeper()
+        if sweeper:
+            sweeper.start()
+
+    #drives the timing wheel (resends, request expiry, cache ttl) until stopped
+    def tick_loop(self, stopped):
+        while not stopped.wait(self.tick_interval):
+            self.timers.advance()
+
+    def new_future(self):
+        return Future()
+
+    #round trip of a request we sent, from its timestamp (our clock) to now, per module that answered
+    def record_rtt(self, response):
+        if response['timestamp'] != "":
+            self.metrics.histogram('samen_request_rtt_seconds', "request to response, resends included", to=response['from']).observe(
+                time.time() - response['timestamp'])
+
+    #the handler's metrics with per second rates since the last report, and the shared cache's counters
+    def metrics_snapshot(self):
+        return {'metrics': self.metrics.snapshot(), 'rates': self.metrics.rates(), 'cache': cache_snapshot()}
+
+    def metrics_text(self):
+        return self.metrics.prometheus()
+
+    #publishes the metrics snapshot as a notice and schedules the next one
+    def report_metrics(self):
+        try:
+            notice = Message.notice(self.broker_data['client_id'], self.metrics_snapshot(), 'metrics')
+            self.publish_to_topics(self.broker_data['publish_to'], notice)
+        finally:
+            self.timers.schedule(self.report_interval, self.report_metrics)
+
+    def resend_request(self, message):
+        self.publish_to_topics(self.broker_data['publish_to'], message)
 
     #prepares the message to be sent
     def prepare_message(self, message_data={}, respond_to={}, cache=[False, 0]):
-        message = MESSAGE_TEMPLATE
-        if not respond_to:
-            message['data'] = {'message': message_data['message'], 'type': message_data['data_type']}
-            message['to'], message['from'], message['type'] = message_data.get('to', 'all'), self.broker_data['client_id'], message_data['type']
-            message['id'] = hashlib.md5(json.dumps(message['data']).encode('utf-8')).hexdigest()
-            message['timestamp'], message['cache'] = time.time(), cache
-        elif respond_to:
-            message['data'] = {'message': message_data['message'], 'type': message_data['type']}
-            message['to'], message['from'] = respond_to['from'], self.broker_data['client_id']
-            message['id'] = hashlib.md5(json.dumps(message['data']).encode('utf-8')).hexdigest()
-            message['req_id'], message['timestamp'] = respond_to['id'], respond_to['timestamp']
-            message['re_timestamp'], message['cache'], message['type'] = time.time(), respond_to['cache'], 'response'
-        return message
+        if respond_to:
+            return Message.response(respond_to, self.broker_data['client_id'], message_data['message'], message_data['type'])
+        return Message.new(message_data['type'], self.broker_data['client_id'], message_data['message'], message_data['data_type'],
+                           to=message_data.get('to', 'all'), cache=cache)
     
     def send_to_action(self, message):
-        response, message = self.cache_message(message)
+        response, message = self.cache_message(message, refresh=message['type'] == 'request')
         return [True, response] if response else [False, message]
             
-    def send_message(self, message_data={}, reply_to={}, cache=[False, 0]):
+    def send_message(self, message_data={}, reply_to={}, cache=[False, 0], qos=None, retain=None):
         message = self.prepare_message(message_data=message_data, respond_to=reply_to, cache=cache)
         skip, response = self.send_to_action(message)
         if skip:
             self.handle_message(response, skip=True)
         else:
-            self.publish_to_topics(self.broker_data['publish_to'], message)
+            self.publish_to_topics(self.broker_data['publish_to'], message, qos=qos, retain=retain)
+        if reply_to and reply_to['type'] == 'request':
+            with self.answers_lock:
+                self.answers[(reply_to['from'], reply_to['id'], reply_to['timestamp'])] = message
+                if len(self.answers) > self.answers_limit:
+                    self.answers.popitem(last=False)
         return True
 
+    #key identical in-flight requests are coalesced on, None if the request is sent on its own
+    #coalesce=None follows the policy for the data type, True or False overrides it
+    def coalesce_key(self, message, coalesce=None):
+        if coalesce or (coalesce is None and message['data']['type'] in self.coalesce):
+            return (message['to'], message['key'] or content_key(message['data'], message['to']))
+        return None
+
+    #sends a request and returns a future completed by the matching response or RequestTimeout
+    def send_request(self, message_data={}, cache=[False, 0], callback=None, timeout=None, coalesce=None):
+        message = self.prepare_message(message_data={**message_data, 'type': 'request'}, cache=cache)
+        skip, response = self.send_to_action(message)
+        if skip:
+            future = self.new_future()
+            future.set_result(response)
+            if callback:
+                future.add_done_callback(callback)
+            return future
+        future, is_new = self.pending.add(message, callback=callback, timeout=timeout, key=self.coalesce_key(message, coalesce))
+        if is_new:
+            self.publish_to_topics(self.broker_data['publish_to'], message)
+        return future
+
     def handle_message(self, message, skip=False):
-        print(F'{message}')
+        if message['type'] in ('response', 'error') and self.pending.resolve(message):
+            self.record_rtt(message)
+        self.log.message(logging.DEBUG, "handling message", message)
         if message['type'] == 'request' and self.request_handler:
             self.request_handler(message)
         elif message['type'] == 'response' and self.response_handler:
@@ -168,12 +549,169 @@ class MqttMessageHandler:
             self.message_handler(message)
 
 
+#runs the paho client on an asyncio event loop instead of the loop_start() thread
+#handlers run on the loop (async ones as tasks), so there is no worker pool dispatch
+class AsyncMqttMessageHandler(MqttMessageHandler):
+    def __init__(self, broker_data=BROKER_DATA, call_backs={}, handlers={}, my_id="", request_policy=REQUEST_POLICY, codec='json', batching=None, qos_policy=QOS_POLICY, dedup=DEDUP_POLICY, coalesce=COALESCE_POLICY, metrics=METRICS_POLICY, logging_policy=LOG_POLICY, routing=None, compression=None, local=None, loop=None) -> None:
+        self.loop = loop
+        self.misc_task = self.reconnect_task = None
+        self.tasks = set() # async handlers still running, the loop itself only holds weak references to tasks
+        self.stopping = False
+        super().__init__(broker_data=broker_data, call_backs=call_backs, handlers=handlers, my_id=my_id, request_policy=request_policy, dispatch=None, codec=codec, batching=batching, qos_policy=qos_policy, dedup=dedup, coalesce=coalesce, metrics=metrics, logging_policy=logging_policy, routing=routing, compression=compression, local=local)
+
+    #the client is connected in start() once the socket callbacks are bound to the loop
+    def get_client(self, broker_data=None, clean_session=True, connect=False):
+        client = super().get_client(broker_data=broker_data, clean_session=clean_session, connect=connect)
+        if client:
+            client.on_socket_open = self.on_socket_open
+            client.on_socket_close = self.on_socket_close
+            client.on_socket_register_write = self.on_socket_register_write
+            client.on_socket_unregister_write = self.on_socket_unregister_write
+        return client
+
+    #runs a socket callback on the loop, paho calls them from the executor thread while connecting
+    #file descriptors are passed rather than sockets so a close queued before a reopen still applies to the old one
+    def on_loop(self, callback, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    #registers the client socket with the event loop
+    def on_socket_open(self, client, userdata, sock):
+        self.on_loop(self.socket_opened, sock.fileno())
+
+    def socket_opened(self, fd):
+        self.loop.add_reader(fd, self.client.loop_read)
+        if self.misc_task:
+            self.misc_task.cancel()
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.on_loop(self.socket_closed, sock.fileno())
+
+    def socket_closed(self, fd):
+        self.loop.remove_reader(fd)
+        if self.misc_task:
+            self.misc_task.cancel()
+            self.misc_task = None
+        self.schedule_reconnect()
+
+    #paho asks for write readiness only while it has outgoing data queued
+    def on_socket_register_write(self, client, userdata, sock):
+        self.on_loop(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.on_loop(self.loop.remove_writer, sock.fileno())
+
+    def on_disconnect(self, client, userdata, rc):
+        self.on_loop(self.schedule_reconnect)
+
+    #keepalive pings and retries, what loop_start() would do on its thread
+    #a lost connection ends it, socket_closed() starts the reconnect and socket_opened() the next one
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+    #loop_start() reconnects on its own thread, on the loop it is up to us, call on the loop
+    def schedule_reconnect(self):
+        if not self.stopping and (self.reconnect_task is None or self.reconnect_task.done()):
+            self.reconnect_task = self.loop.create_task(self.reconnect())
+
+    async def reconnect(self):
+        delay = RECONNECT_DELAY['min_delay']
+        while not self.stopping:
+            await asyncio.sleep(delay)
+            try:
+                await self.loop.run_in_executor(None, self.client.reconnect) # dns, tcp and tls would block the loop
+                return
+            except OSError as e:
+                self.log.log.warning("reconnecting %s failed: %r", self.broker_data['client_id'], e)
+                delay = min(delay * 2, RECONNECT_DELAY['max_delay'])
+
+    #starts the client on the running loop
+    async def start(self):
+        if self.client:
+            self.loop = self.loop or asyncio.get_running_loop()
+            self.start_logging()
+            self.log.log.info("starting client %s", self.broker_data['client_id'])
+            self.stopping = False
+            await self.loop.run_in_executor(None, self.connect_client, self.client, self.broker_data)
+            if self.local:
+                self.local.start_async(self.loop, self.receive)
+            self.ticker = self.loop.create_task(self.tick_loop())
+            self.start_sweeper()
+            if self.report_interval:
+                self.timers.schedule(self.report_interval, self.report_metrics)
+
+    #stops the client and fails whatever is still waiting for a response
+    async def stop(self):
+        if self.batcher:
+            self.batcher.flush()
+        self.stopping = True
+        if self.reconnect_task:
+            self.reconnect_task.cancel()
+        if self.client:
+            self.client.disconnect()
+        if self.local:
+            self.local.stop(self.loop)
+        if self.ticker:
+            self.ticker.cancel()
+        self.pending.cancel()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def tick_loop(self):
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            self.timers.advance()
+
+    def new_future(self):
+        return self.loop.create_future()
+
+    #sends a request and waits for the matching response, raises RequestTimeout once the resends run out
+    async def send_request(self, message_data={}, cache=[False, 0], callback=None, timeout=None, coalesce=None):
+        return await super().send_request(message_data=message_data, cache=cache, callback=callback, timeout=timeout, coalesce=coalesce)
+
+    def handle_message(self, message, skip=False):
+        if message['type'] in ('response', 'error') and self.pending.resolve(message):
+            self.record_rtt(message)
+        self.log.message(logging.DEBUG, "handling message", message)
+        result = None
+        if message['type'] == 'request' and self.request_handler:
+            result = self.request_handler(message)
+        elif message['type'] == 'response' and self.response_handler:
+            result = self.response_handler(message)
+        elif self.message_handler:
+            result = self.message_handler(message)
+        if inspect.isawaitable(result): # async handlers run as tasks so they never block the network callbacks
+            task = asyncio.ensure_future(result, loop=self.loop)
+            self.tasks.add(task)
+            task.add_done_callback(self.handler_done)
+
+    def handler_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.log.log.error("async handler failed", exc_info=task.exception())
+
+
+#run as python -m essentials.intercom
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run CHEAPRAY network manager')
     parser.add_argument('--client', type=str, default='nitb', help='Client ID to run as')
     parser.add_argument('--remote', type=str, default='nitb', help='Client ID to run as')
+    parser.add_argument('--local', action='store_true', help='use the broker of essentials.broker on this machine')
     args = parser.parse_args()
-    broker_data = BROKER_DATA.copy()
+    broker_data = (LOCAL_BROKER_DATA if args.local else BROKER_DATA).copy()
     if args.client and args.remote:
         broker_data.update({'client_id': args.client, 'subscribe_to': [args.client], 'publish_to': [args.remote]})
 
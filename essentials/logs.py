@@ -0,0 +1,118 @@
+##structured logging off the message path
+##records go through a queue to a background writer that formats them as json lines, a logged message is queued
+##as a plain tuple and only becomes a LogRecord on the writer. messages are immutable, which is what makes that safe
+##everything logs under the 'samen' logger, start() attaches the writer, without it records go wherever
+##the application's logging config sends them
+
+import atexit, json, logging, queue, random, sys, threading, time
+from logging.handlers import QueueHandler, QueueListener
+
+logger = logging.getLogger('samen')
+
+
+#one json object per line: time, level, logger, event, and the message that was logged if any
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'logger': record.name, 'event': record.getMessage()}
+        message = getattr(record, 'samen_message', None)
+        if message is not None:
+            fields = dict(message)
+            if getattr(record, 'envelope_only', False):
+                fields.pop('data', None)
+            entry['message'] = fields
+        if record.exc_info:
+            entry['error'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+#queues the record as it is, QueueHandler would format it on the calling thread
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        if record.exc_info: # tracebacks hold frames that will have moved on by the time the writer gets to them
+            return super().prepare(record)
+        return record
+
+
+#builds the records for messages queued by MessageLog
+class MessageListener(QueueListener):
+    def prepare(self, record):
+        if isinstance(record, tuple):
+            created, name, level, event, message, envelope_only = record
+            record = logging.getLogger(name).makeRecord(name, level, "", 0, event, (), None,
+                                                        extra={'samen_message': message, 'envelope_only': envelope_only})
+            record.created = created
+        return record
+
+
+_listener = _records = None
+_lock = threading.Lock()
+
+
+#attaches the queue and starts the writer, does nothing if it is already running
+#the writer is shared by everything in the process and is drained at exit
+def start(stream=None, level=logging.INFO):
+    global _listener, _records
+    with _lock:
+        if _listener is None:
+            records = queue.SimpleQueue()
+            writer = logging.StreamHandler(stream or sys.stdout)
+            writer.setFormatter(StructuredFormatter())
+            _listener = MessageListener(records, writer)
+            _records = records
+            logger.addHandler(DeferredQueueHandler(records))
+            logger.setLevel(level)
+            logger.propagate = False
+            _listener.start()
+            atexit.register(stop)
+
+
+#writes out what is queued and detaches the writer
+def stop():
+    global _listener, _records
+    with _lock:
+        if _listener is not None:
+            _records = None
+            for handler in [handler for handler in logger.handlers if isinstance(handler, DeferredQueueHandler)]:
+                logger.removeHandler(handler)
+            _listener.stop()
+            _listener = None
+            logger.propagate = True
+
+
+#logs messages with per type sampling and rate limits, checks the level before doing anything else
+class MessageLog:
+    # sample is {type: fraction logged}, rate is {type: most logged per second} with None for other types
+    def __init__(self, log=logger, envelope_only=False, sample=None, rate=None, dropped=None) -> None:
+        self.log, self.envelope_only = log, envelope_only
+        self.ours = log is logger or log.name.startswith(logger.name + '.') # goes to our writer once it runs
+        self.sample, self.rate = sample or {}, rate or {}
+        self.buckets = {} # type -> [tokens, last refill], approximate under threads, which is fine for a limit
+        self.dropped = dropped # a metrics.Counter for what sampling and rate limits left out
+
+    def allow(self, kind, limit):
+        now = time.monotonic()
+        bucket = self.buckets.get(kind)
+        if bucket is None:
+            bucket = self.buckets[kind] = [limit, now]
+        bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def message(self, level, event, message):
+        if not self.log.isEnabledFor(level):
+            return
+        kind = message['type']
+        fraction = self.sample.get(kind, 1.0)
+        limit = self.rate.get(kind, self.rate.get(None))
+        if (fraction < 1.0 and random.random() >= fraction) or (limit is not None and not self.allow(kind, limit)):
+            if self.dropped is not None:
+                self.dropped.inc()
+            return
+        records = _records
+        if records is not None and self.ours:
+            records.put((time.time(), self.log.name, level, event, message, self.envelope_only))
+        else: # no writer of ours, the application's handlers get a normal record
+            self.log.log(level, event, extra={'samen_message': message, 'envelope_only': self.envelope_only})
@@ -0,0 +1,110 @@
+##immutable message passed between the modules
+##replaces filling in the shared MESSAGE_TEMPLATE dict, every message is its own object
+##reads like the old dict (message['from'], message.get('cache')) so existing handlers keep working
+
+import json, time
+from collections.abc import Mapping
+from .ids import new_id, content_key
+
+#wire keys in the order of MESSAGE_TEMPLATE and the attribute holding each, 'from' is a keyword
+FIELDS = ('id', 'type', 'from', 'to', 'timestamp', 'data', 'req_id', 're_timestamp', 'cache', 'key')
+ATTRIBUTES = dict(zip(FIELDS, ('id', 'type', 'sender', 'to', 'timestamp', 'data', 'req_id', 're_timestamp', 'cache', 'key')))
+
+
+#same layout as Message without the write guard, a message is filled in as this and then frozen
+class MessageFields:
+    __slots__ = tuple(ATTRIBUTES.values())
+
+
+class Message(MessageFields, Mapping):
+    __slots__ = ()
+
+    def __new__(cls, id="", type="", sender="", to="all", timestamp="", data=None, req_id="", re_timestamp="", cache=(False, 0), key=""):
+        self = object.__new__(MessageFields)
+        self.id, self.type, self.sender, self.to, self.timestamp = id, type, sender, to, timestamp
+        self.data = data if data is not None else {'message': "", 'type': ""}
+        self.req_id, self.re_timestamp, self.cache, self.key = req_id, re_timestamp, cache, key
+        self.__class__ = cls # much cheaper than object.__setattr__ per field
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError(F"Message is immutable, use replace() to change {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError("Message is immutable")
+
+    #builds a message to everyone or to one module, the cache key is only worked out when caching is asked for
+    @classmethod
+    def new(cls, type, sender, message, data_type='text', to='all', cache=(False, 0)):
+        data = {'message': message, 'type': data_type}
+        return cls(new_id(), type, sender, to, time.time(), data, cache=cache, key=content_key(data, to) if cache[0] else "")
+
+    @classmethod
+    def notice(cls, sender, message, data_type='text', to='all', cache=(False, 0)):
+        return cls.new('notice', sender, message, data_type, to, cache)
+
+    @classmethod
+    def request(cls, sender, message, data_type='text', to='all', cache=(False, 0)):
+        return cls.new('request', sender, message, data_type, to, cache)
+
+    #builds the answer to a request, it goes back to the sender and carries the request's id, timestamp and cache key
+    @classmethod
+    def response(cls, request, sender, message, data_type='text', type='response'):
+        data = {'message': message, 'type': data_type}
+        return cls(new_id(), type, sender, request['from'], request['timestamp'], data,
+                   request['id'], time.time(), request['cache'], request.get('key', ""))
+
+    #copy with some fields changed, keys are wire names ('from' not 'sender')
+    def replace(self, **changes):
+        fields = self.to_dict()
+        fields.update(changes)
+        return Message.from_dict(fields)
+
+    #dict view for code that wants a plain, mutable dict
+    def to_dict(self):
+        return {'id': self.id, 'type': self.type, 'from': self.sender, 'to': self.to, 'timestamp': self.timestamp,
+                'data': self.data, 'req_id': self.req_id, 're_timestamp': self.re_timestamp, 'cache': self.cache, 'key': self.key}
+
+    def to_wire(self):
+        return json.dumps(self.to_dict())
+
+    #missing fields take their MESSAGE_TEMPLATE defaults, unknown ones are ignored
+    #raises ValueError when the fields or the data are not a dict, like any other payload that does not decode
+    @classmethod
+    def from_dict(cls, fields):
+        if not isinstance(fields, dict):
+            raise ValueError(F"message is {type(fields).__name__}, not an object")
+        if not isinstance(fields.get('data', {}), (dict, type(None))):
+            raise ValueError(F"message data is {type(fields['data']).__name__}, not an object")
+        get = fields.get
+        return cls(get('id', ""), get('type', ""), get('from', ""), get('to', 'all'), get('timestamp', ""), get('data'),
+                   get('req_id', ""), get('re_timestamp', ""), tuple(get('cache', (False, 0))), get('key', ""))
+
+    @classmethod
+    def from_wire(cls, payload):
+        return cls.from_dict(json.loads(payload))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, ATTRIBUTES[key])
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def __len__(self):
+        return len(FIELDS)
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            return all(getattr(self, name) == getattr(other, name) for name in MessageFields.__slots__)
+        return Mapping.__eq__(self, other)
+
+    __hash__ = None # data is a dict, so messages are not hashable
+
+    def __reduce__(self):
+        return (Message, tuple(getattr(self, name) for name in MessageFields.__slots__))
+
+    def __repr__(self):
+        return F"Message({self.to_dict()})"
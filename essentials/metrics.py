@@ -0,0 +1,187 @@
+##low overhead instruments for the hot paths, read through snapshots
+##MetricsRegistry names them and exports them, MqttMessageHandler keeps one per handler (see its metrics attribute)
+
+import bisect, math, threading, time
+
+#seconds, from 10us to 1s, anything slower lands in the last bucket
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+#counts observations into fixed buckets, observe() is a bisect and three additions
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS) -> None:
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count, self.total = 0, 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.add(value)
+
+    #observe() for callers already holding a lock of their own that covers the histogram
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    #cumulative count per upper bound (prometheus style), the count and the sum of everything observed
+    def snapshot(self):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.total
+        buckets, running = {}, 0
+        for bound, n in zip((*self.bounds, float('inf')), counts):
+            running += n
+            buckets[bound] = running
+        return {'buckets': buckets, 'count': count, 'sum': total}
+
+
+#adds without a lock: every thread counts into a cell of its own and value() sums the cells
+class Counter:
+    def __init__(self) -> None:
+        self.cells = []
+        self.local = threading.local()
+        self.lock = threading.Lock() # only taken the first time a thread counts
+
+    def inc(self, amount=1):
+        cell = getattr(self.local, 'cell', None)
+        if cell is None:
+            cell = self.local.cell = [0]
+            with self.lock:
+                self.cells.append(cell)
+        cell[0] += amount
+
+    def value(self):
+        return sum(cell[0] for cell in self.cells)
+
+
+#reads its value from a function when a snapshot is taken
+class Gauge:
+    def __init__(self, read) -> None:
+        self.read = read
+
+    def value(self):
+        return self.read()
+
+
+#hdr style histogram: every power of two above `lowest` is split into `precision` equal buckets so a value is
+#known to within 1/precision of itself, from 1us to over an hour with the defaults. lock-free like Counter
+class LogHistogram:
+    def __init__(self, lowest=1e-6, precision=32, octaves=32) -> None:
+        self.lowest, self.precision = lowest, precision
+        self.size = octaves * precision + 1
+        self.cells = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def index(self, value):
+        if value < self.lowest: # also zero and the negatives a clock step can give
+            return 0
+        mantissa, exponent = math.frexp(value / self.lowest) # 0.5 <= mantissa < 1
+        return min((exponent - 1) * self.precision + int((mantissa * 2 - 1) * self.precision) + 1, self.size - 1)
+
+    #upper edge of a bucket
+    def bound(self, index):
+        if index == 0:
+            return self.lowest
+        octave, step = divmod(index - 1, self.precision)
+        return self.lowest * 2 ** octave * (1 + (step + 1) / self.precision)
+
+    def observe(self, value):
+        cell = getattr(self.local, 'cell', None)
+        if cell is None:
+            cell = self.local.cell = [[0] * self.size, 0.0]
+            with self.lock:
+                self.cells.append(cell)
+        cell[0][self.index(value)] += 1
+        cell[1] += value
+
+    #counts of all threads added up, and the sum of everything observed
+    def merged(self):
+        counts, total = [0] * self.size, 0.0
+        for cell in self.cells:
+            counts = [a + b for a, b in zip(counts, cell[0])]
+            total += cell[1]
+        return counts, total
+
+    def snapshot(self, quantiles=(0.5, 0.9, 0.99)):
+        counts, total = self.merged()
+        count, found, running, index = sum(counts), {}, 0, 0
+        for quantile in sorted(quantiles):
+            while index < self.size and running + counts[index] < quantile * count:
+                running += counts[index]
+                index += 1
+            found[quantile] = self.bound(min(index, self.size - 1)) if count else 0.0
+        return {'count': count, 'sum': total, 'quantiles': found}
+
+
+#named instruments, optionally labelled, exported as a dict or in the prometheus text format
+class MetricsRegistry:
+    KINDS = {Counter: 'counter', Gauge: 'gauge', LogHistogram: 'summary'}
+
+    def __init__(self) -> None:
+        self.instruments = {} # (name, labels) -> instrument
+        self.help = {}
+        self.previous = (time.monotonic(), {}) # counter values at the last rates() call
+        self.lock = threading.Lock()
+
+    def get(self, factory, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        instrument = self.instruments.get(key)
+        if instrument is None:
+            with self.lock:
+                instrument = self.instruments.get(key)
+                if instrument is None:
+                    instrument = self.instruments[key] = factory()
+                    self.help.setdefault(name, help)
+        return instrument
+
+    def counter(self, name, help="", **labels):
+        return self.get(Counter, name, help, labels)
+
+    def gauge(self, name, read, help="", **labels):
+        return self.get(lambda: Gauge(read), name, help, labels)
+
+    def histogram(self, name, help="", **labels):
+        return self.get(LogHistogram, name, help, labels)
+
+    @staticmethod
+    def label_text(labels, extra=()):
+        pairs = [*labels, *extra]
+        return "{%s}" % ",".join(F'{key}="{value}"' for key, value in pairs) if pairs else ""
+
+    def items(self):
+        with self.lock:
+            return sorted(self.instruments.items(), key=lambda item: item[0])
+
+    #{'name{label="value"}': value}, histograms as their snapshot
+    def snapshot(self):
+        return {name + self.label_text(labels): instrument.snapshot() if isinstance(instrument, LogHistogram) else instrument.value()
+                for (name, labels), instrument in self.items()}
+
+    #per second rate of every counter since the previous call
+    def rates(self):
+        now = time.monotonic()
+        values = {name + self.label_text(labels): instrument.value()
+                  for (name, labels), instrument in self.items() if isinstance(instrument, Counter)}
+        last, previous = self.previous
+        self.previous = (now, values)
+        elapsed = max(now - last, 1e-9)
+        return {name: (value - previous.get(name, 0)) / elapsed for name, value in values.items()}
+
+    def prometheus(self):
+        lines, described = [], set()
+        for (name, labels), instrument in self.items():
+            if name not in described:
+                described.add(name)
+                lines.append(F"# HELP {name} {self.help.get(name) or name}")
+                lines.append(F"# TYPE {name} {self.KINDS[type(instrument)]}")
+            if isinstance(instrument, LogHistogram):
+                summary = instrument.snapshot()
+                for quantile, value in summary['quantiles'].items():
+                    lines.append(F"{name}{self.label_text(labels, [('quantile', quantile)])} {value:.6g}")
+                lines.append(F"{name}_sum{self.label_text(labels)} {summary['sum']:.6g}")
+                lines.append(F"{name}_count{self.label_text(labels)} {summary['count']}")
+            else:
+                lines.append(F"{name}{self.label_text(labels)} {instrument.value()}")
+        return "\n".join(lines) + "\n"
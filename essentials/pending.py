@@ -0,0 +1,122 @@
+##table of outstanding requests waiting for a response
+##requests are keyed by their message id and matched through the req_id of the response
+##unanswered requests are resent with capped exponential backoff and failed once the retries run out
+##each request holds one timer on the timing wheel, so nothing is scanned per tick
+##requests added with a coalescing key attach to an outstanding request with the same key instead of being sent again
+
+import threading
+from concurrent.futures import Future
+from .timers import TimingWheel
+
+
+#raised into the future of a request that got no response after all retries
+class RequestTimeout(TimeoutError):
+    pass
+
+
+class PendingRequest:
+    __slots__ = ('message', 'future', 'attempts', 'timer', 'timeout', 'key')
+
+    def __init__(self, message, future, timeout=None, key=None) -> None:
+        self.message, self.future, self.attempts, self.timer, self.timeout = message, future, 0, None, timeout
+        self.key = key
+
+
+class PendingRequests:
+    # resend is called with the stored message whenever a request is due to be sent again
+    def __init__(self, resend, wheel=None, timeout=10, retries=5, backoff=2, max_delay=60, future_factory=Future) -> None:
+        self.resend = resend
+        self.wheel = TimingWheel() if wheel is None else wheel
+        self.timeout, self.retries, self.backoff, self.max_delay = timeout, retries, backoff, max_delay
+        self.future_factory = future_factory
+        self.requests = {}
+        self.inflight = {} # coalescing key -> id of the outstanding request it belongs to
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __contains__(self, request_id):
+        return request_id in self.requests
+
+    #delay before the given attempt times out, doubling up to max_delay
+    def delay(self, attempt, timeout=None):
+        return min((timeout or self.timeout) * self.backoff ** attempt, self.max_delay)
+
+    #tracks a request, identical ids or coalescing keys share one future. returns (future, is_new)
+    def add(self, message, callback=None, timeout=None, key=None):
+        with self.lock:
+            entry = self.requests.get(message['id'])
+            if entry is None and key is not None:
+                entry = self.requests.get(self.inflight.get(key))
+                if entry is not None:
+                    self.coalesced += 1
+            is_new = entry is None
+            if is_new:
+                entry = PendingRequest(message, self.future_factory(), timeout, key)
+                entry.timer = self.wheel.schedule(self.delay(0, timeout), self.expire, message['id'])
+                self.requests[message['id']] = entry
+                if key is not None:
+                    self.inflight[key] = message['id']
+        if callback:
+            entry.future.add_done_callback(callback)
+        return entry.future, is_new
+
+    #completes the request a response belongs to, returns False for unsolicited responses
+    def resolve(self, response):
+        with self.lock:
+            entry = self.requests.pop(response.get('req_id'), None)
+            self.forget(entry)
+        if entry is None:
+            return False
+        self.wheel.cancel(entry.timer)
+        if not entry.future.done():
+            entry.future.set_result(response)
+        return True
+
+    #fails a single request, or every request when no id is given
+    def cancel(self, request_id=None, exc=None):
+        with self.lock:
+            if request_id is None:
+                entries, self.requests, self.inflight = list(self.requests.values()), {}, {}
+            else:
+                entries = [self.requests.pop(request_id)] if request_id in self.requests else []
+                for entry in entries:
+                    self.forget(entry)
+        for entry in entries:
+            self.wheel.cancel(entry.timer)
+            if entry.future.done():
+                continue
+            if exc:
+                entry.future.set_exception(exc)
+            else:
+                entry.future.cancel()
+        return len(entries)
+
+    #called by the wheel when an attempt times out, resends or fails the request
+    def expire(self, request_id):
+        with self.lock:
+            entry = self.requests.get(request_id)
+            if entry is None:
+                return
+            retry = entry.attempts < self.retries
+            if retry:
+                entry.attempts += 1
+                entry.timer = self.wheel.schedule(self.delay(entry.attempts, entry.timeout), self.expire, request_id)
+            else:
+                del self.requests[request_id]
+                self.forget(entry)
+        if retry:
+            self.resend(entry.message)
+        elif not entry.future.done():
+            entry.future.set_exception(RequestTimeout(F"no response to request {request_id} after {entry.attempts} resends"))
+
+    #drops the coalescing key of a finished request, call with the lock held
+    def forget(self, entry):
+        if entry is not None and entry.key is not None and self.inflight.get(entry.key) == entry.message['id']:
+            del self.inflight[entry.key]
+
+    def stats(self):
+        with self.lock:
+            return {'pending': len(self.requests), 'coalescing': len(self.inflight), 'coalesced': self.coalesced}
@@ -0,0 +1,38 @@
+##routes messages by topic so a module only decodes what is addressed to it
+##a routed message goes out on <prefix>/<to>/<type>. a module subscribes to <prefix>/<its id>/+ and
+##<prefix>/all/+ and paho hands those to their callback (message_callback_add) without decoding anything.
+##a routed topic that still reaches the default callback (through a wildcard or shared subscription)
+##is addressed to another module and is dropped unread
+
+from paho.mqtt.matcher import MQTTMatcher
+
+RESERVED = ('/', '+', '#') # would change the shape of the topic
+
+
+class Router:
+    def __init__(self, module, prefix='samen', broadcast='all') -> None:
+        self.module, self.prefix, self.broadcast = module, prefix, broadcast
+        self.matcher = MQTTMatcher()
+        for topic_filter in self.filters():
+            self.matcher[topic_filter] = topic_filter
+        self.topics = {} # (to, type) -> topic, one per module and message type in use
+
+    #what this module subscribes to
+    def filters(self):
+        return [F"{self.prefix}/{self.module}/+", F"{self.prefix}/{self.broadcast}/+"]
+
+    def topic(self, message):
+        key = (message['to'], message['type'])
+        topic = self.topics.get(key)
+        if topic is None:
+            if any(not part or any(char in part for char in RESERVED) for part in key):
+                raise ValueError(F"cannot route to {key[0]!r} with type {key[1]!r}")
+            topic = self.topics[key] = F"{self.prefix}/{key[0]}/{key[1]}"
+        return topic
+
+    #true for any routed topic, whoever it is addressed to
+    def routed(self, topic):
+        return topic.startswith(self.prefix + '/')
+
+    def accepts(self, topic):
+        return next(self.matcher.iter_match(topic), None) is not None
@@ -0,0 +1,272 @@
+##chunked file transfer on top of MqttMessageHandler
+##the sender opens a transfer with a request and the receiver answers with how much of it it already has,
+##the id of a transfer is the hash of the file so sending the same file again resumes where it stopped
+##  stream-open   request   {'transfer', 'name', 'size', 'chunk_size', 'data_type'}
+##  stream-ready  response  {'transfer', 'next', 'done'}        next is the first chunk the receiver is missing
+##  stream-chunk  notice    {'transfer', 'seq', 'crc', 'data'}  data is base64, crc is the crc32 of the raw bytes
+##  stream-ack    notice    {'transfer', 'next', 'gap', 'done', 'error'}
+##at most `window` chunks are unacknowledged. the receiver only takes chunks in order and acks every `ack_every`
+##chunks and at the end. a gap or bad crc gets an ack with gap set and the sender goes back to `next`,
+##a window with no ack for `timeout` seconds is sent again from the last ack
+##neither side holds more than a chunk in memory: the sender reads each chunk from the file when it sends it
+##and the receiver appends it to <directory>/<transfer>.part, moved to its name once the hash matches
+
+import base64, hashlib, os, threading, zlib
+from collections import OrderedDict
+from .pending import RequestTimeout
+
+STREAM_TYPES = ('stream-open', 'stream-ready', 'stream-chunk', 'stream-ack')
+
+STREAM_POLICY = {
+    'chunk_size': 32768, #raw bytes per chunk, a third more on the wire as base64
+    'window': 16, #chunks in flight before waiting for an ack
+    'ack_every': 4, #the receiver acks after this many chunks in order
+    'timeout': 5, #seconds without an ack before the window is sent again
+    'retries': 10, #windows sent again without progress before the transfer fails
+    'directory': "/var/lib/samen/incoming", #where received files go
+    'max_incoming': 100, #transfers a receiver keeps state for, the oldest is forgotten (its .part stays for a resume)
+}
+
+
+#hash of a file read in chunks, the transfer id
+def file_hash(path, chunk_size=1 << 16):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_transfer_id(value):
+    return isinstance(value, str) and len(value) == 32 and all(char in '0123456789abcdef' for char in value)
+
+
+class Outgoing:
+    def __init__(self, transfer, path, to, size, chunk_size, future, progress) -> None:
+        self.transfer, self.path, self.to, self.size, self.chunk_size = transfer, path, to, size, chunk_size
+        self.chunks = -(-size // chunk_size)
+        self.future, self.progress = future, progress
+        self.file = None
+        self.acked = self.sent = self.stalls = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+
+class Incoming:
+    def __init__(self, transfer, name, size, chunk_size, data_type, part) -> None:
+        self.transfer, self.name, self.size, self.chunk_size, self.data_type = transfer, name, size, chunk_size, data_type
+        self.chunks = -(-size // chunk_size)
+        self.part = part
+        self.next, self.acked, self.digest = 0, -1, hashlib.blake2b(digest_size=16)
+        self.lock = threading.Lock()
+
+
+#sends and receives files for a handler, attaching sets handler.streams so stream messages are taken off its path
+#on_file(path, info) is called for every file received, progress(transfer, bytes done, total) on both ends
+class Streams:
+    def __init__(self, handler, policy=STREAM_POLICY, on_file=None, progress=None) -> None:
+        self.handler, self.policy = handler, dict(STREAM_POLICY, **policy)
+        self.on_file, self.progress = on_file, progress
+        self.outgoing = {} # (to, transfer) -> Outgoing
+        self.incoming = OrderedDict() # transfer -> Incoming, oldest first
+        self.lock = threading.Lock()
+        handler.streams = self
+
+    #takes the stream messages, returns False for everything else
+    def handle(self, message):
+        kind = message['data'].get('type')
+        if kind not in STREAM_TYPES:
+            return False
+        body = message['data']['message']
+        if kind == 'stream-open':
+            self.opened(message, body)
+        elif kind == 'stream-ready':
+            self.handler.pending.resolve(message)
+        elif kind == 'stream-chunk':
+            self.chunk(message, body)
+        else:
+            self.acked(message['from'], body)
+        return True
+
+    def send(self, to, data_type, body):
+        self.handler.send_message(message_data={'message': body, 'data_type': data_type, 'type': 'notice', 'to': to})
+
+    ## sending
+
+    #starts sending a file, returns a future with {'transfer', 'size'} once the receiver has all of it
+    def send_file(self, path, to, data_type='file', progress=None):
+        transfer, size = file_hash(path), os.path.getsize(path)
+        future = self.handler.new_future()
+        state = Outgoing(transfer, path, to, size, self.policy['chunk_size'], future, progress or self.progress)
+        with self.lock:
+            if (to, transfer) in self.outgoing:
+                return self.outgoing[(to, transfer)].future
+            self.outgoing[(to, transfer)] = state
+        body = {'transfer': transfer, 'name': os.path.basename(path), 'size': size, 'chunk_size': state.chunk_size, 'data_type': data_type}
+        request = self.handler.prepare_message(message_data={'message': body, 'data_type': 'stream-open', 'type': 'request', 'to': to})
+        self.handler.pending.add(request, callback=lambda ready: self.ready(state, ready))
+        self.handler.publish_to_topics(self.handler.broker_data['publish_to'], request)
+        return future
+
+    def ready(self, state, ready):
+        if ready.cancelled() or ready.exception():
+            self.finish(state, ready.exception() or RequestTimeout(F"transfer {state.transfer} was cancelled"))
+            return
+        body = ready.result()['data']['message']
+        if body.get('done'):
+            self.finish(state)
+            return
+        with state.lock:
+            state.file = open(state.path, 'rb')
+            state.acked = state.sent = body['next']
+        self.pump(state)
+
+    #sends chunks one at a time until the window is full, then sets the timer for the next ack
+    def pump(self, state):
+        while True:
+            with state.lock:
+                if state.file is None or state.sent >= state.chunks or state.sent - state.acked >= self.policy['window']:
+                    break
+                seq = state.sent
+                state.file.seek(seq * state.chunk_size)
+                raw = state.file.read(state.chunk_size)
+                state.sent += 1
+            self.send(state.to, 'stream-chunk', {'transfer': state.transfer, 'seq': seq, 'crc': zlib.crc32(raw),
+                                                 'data': base64.b64encode(raw).decode('ascii')})
+        with state.lock:
+            if state.file is not None:
+                self.handler.timers.cancel(state.timer)
+                state.timer = self.handler.timers.schedule(self.policy['timeout'], self.stalled, state, state.acked)
+
+    def acked(self, sender, body):
+        state = self.outgoing.get((sender, body.get('transfer')))
+        if state is None:
+            return
+        if body.get('error'):
+            self.finish(state, IOError(F"transfer {state.transfer} failed on {sender}: {body['error']}"))
+            return
+        if body.get('done'):
+            self.finish(state)
+            return
+        with state.lock:
+            if body['next'] > state.acked:
+                state.acked, state.stalls = body['next'], 0
+            if body.get('gap'): # the receiver threw away what came after next
+                state.sent = min(state.sent, body['next'])
+        if state.progress:
+            state.progress(state.transfer, min(state.acked * state.chunk_size, state.size), state.size)
+        self.pump(state)
+
+    #the timer of a window, fires unless an ack moved the transfer on
+    def stalled(self, state, acked):
+        with state.lock:
+            if state.file is None or state.acked != acked:
+                return
+            state.stalls += 1
+            failed = state.stalls > self.policy['retries']
+            state.sent = state.acked
+        if failed:
+            self.finish(state, RequestTimeout(F"transfer {state.transfer} got no ack after {state.stalls - 1} resends"))
+        else:
+            self.pump(state)
+
+    def finish(self, state, exc=None):
+        with self.lock:
+            if self.outgoing.get((state.to, state.transfer)) is not state:
+                return
+            del self.outgoing[(state.to, state.transfer)]
+        with state.lock:
+            self.handler.timers.cancel(state.timer)
+            if state.file:
+                state.file.close()
+                state.file = None
+        if state.future.done():
+            return
+        if exc:
+            state.future.set_exception(exc)
+        else:
+            if state.progress:
+                state.progress(state.transfer, state.size, state.size)
+            state.future.set_result({'transfer': state.transfer, 'size': state.size})
+
+    ## receiving
+
+    def opened(self, request, body):
+        transfer = body.get('transfer')
+        if not is_transfer_id(transfer) or body.get('chunk_size', 0) <= 0 or body.get('size', -1) < 0:
+            self.reply(request, {'transfer': transfer, 'next': 0, 'done': False, 'error': 'bad transfer'})
+            return
+        with self.lock:
+            state = self.incoming.get(transfer)
+            if state is None:
+                os.makedirs(self.policy['directory'], exist_ok=True)
+                state = Incoming(transfer, body.get('name', ""), body['size'], body['chunk_size'], body.get('data_type', 'file'),
+                                 os.path.join(self.policy['directory'], transfer + '.part'))
+                self.resume(state)
+                self.incoming[transfer] = state
+                while len(self.incoming) > self.policy['max_incoming']:
+                    self.incoming.popitem(last=False)
+        with state.lock:
+            done = state.next >= state.chunks and self.complete(state)
+            self.reply(request, {'transfer': transfer, 'next': state.next, 'done': done})
+
+    #picks up a .part left by an earlier attempt, whole chunks only
+    def resume(self, state):
+        if not os.path.exists(state.part):
+            open(state.part, 'wb').close()
+            return
+        have = min(os.path.getsize(state.part) // state.chunk_size, state.chunks)
+        with open(state.part, 'r+b') as file:
+            file.truncate(have * state.chunk_size)
+            for _ in range(have):
+                state.digest.update(file.read(state.chunk_size))
+        state.next = have
+
+    def reply(self, request, body):
+        self.handler.send_message(message_data={'message': body, 'type': 'stream-ready'}, reply_to=request)
+
+    def chunk(self, message, body):
+        state = self.incoming.get(body.get('transfer'))
+        if state is None:
+            return
+        with state.lock:
+            if state.next >= state.chunks: # finished, the sender missed the last ack
+                self.ack(message['from'], state, done=True)
+                return
+            if body['seq'] == state.next:
+                raw = base64.b64decode(body['data'])
+                if zlib.crc32(raw) == body['crc']:
+                    with open(state.part, 'ab') as file:
+                        file.write(raw)
+                    state.digest.update(raw)
+                    state.next += 1
+                    if self.progress:
+                        self.progress(state.transfer, min(state.next * state.chunk_size, state.size), state.size)
+                    if state.next == state.chunks:
+                        done = self.complete(state)
+                        self.ack(message['from'], state, done, None if done else 'hash mismatch')
+                    elif state.next % self.policy['ack_every'] == 0:
+                        self.ack(message['from'], state)
+                    return
+            if state.acked != state.next: # out of order, repeated or corrupt, say once where we are
+                self.ack(message['from'], state, gap=True)
+
+    def ack(self, to, state, done=False, error=None, gap=False):
+        state.acked = state.next
+        self.send(to, 'stream-ack', {'transfer': state.transfer, 'next': state.next, 'gap': gap, 'done': done, 'error': error})
+
+    #moves a finished .part to its name if the hash matches, call with the state lock held
+    def complete(self, state):
+        if not os.path.exists(state.part): # moved already, a repeated open or last chunk
+            return True
+        if state.digest.hexdigest() != state.transfer:
+            os.remove(state.part)
+            with self.lock:
+                self.incoming.pop(state.transfer, None)
+            return False
+        name = os.path.basename(state.name).lstrip('.') or state.transfer
+        path = os.path.join(self.policy['directory'], name)
+        os.replace(state.part, path)
+        if self.on_file:
+            self.on_file(path, {'transfer': state.transfer, 'name': state.name, 'size': state.size, 'data_type': state.data_type})
+        return True
@@ -0,0 +1,76 @@
+##hashed timing wheel for request timeouts, resends and cache expiry
+##scheduling and cancelling a timer is O(1) regardless of how many are running
+##the wheel does not run on its own, the owner calls advance() from its loop
+
+import threading, time, math, logging
+
+log = logging.getLogger('samen.timers')
+
+
+class Timer:
+    __slots__ = ('callback', 'args', 'rounds', 'slot')
+
+    def __init__(self, callback, args) -> None:
+        self.callback, self.args, self.rounds, self.slot = callback, args, 0, None
+
+
+class TimingWheel:
+    # tick is the resolution in seconds, a timer fires on the first advance() at or after its tick
+    def __init__(self, tick=0.1, slots=512) -> None:
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.cursor = 0
+        self.last = time.monotonic()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    #runs callback(*args) after delay seconds, returns a handle for cancel()
+    def schedule(self, delay, callback, *args):
+        timer = Timer(callback, args)
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self.lock:
+            timer.rounds = (ticks - 1) // len(self.slots) # full turns of the wheel before it is due
+            timer.slot = (self.cursor + ticks) % len(self.slots)
+            self.slots[timer.slot].add(timer)
+            self.count += 1
+        return timer
+
+    #stops a timer, returns False if it already fired or was cancelled
+    def cancel(self, timer):
+        with self.lock:
+            if timer is None or timer.slot is None or timer not in self.slots[timer.slot]:
+                return False
+            self.slots[timer.slot].discard(timer)
+            timer.slot = None
+            self.count -= 1
+        return True
+
+    #moves the wheel up to now and fires the timers that came due, returns how many fired
+    def advance(self, now=None):
+        now = now or time.monotonic()
+        due = []
+        with self.lock:
+            ticks = int((now - self.last) / self.tick)
+            self.last += ticks * self.tick
+            for _ in range(ticks):
+                self.cursor = (self.cursor + 1) % len(self.slots)
+                slot = self.slots[self.cursor]
+                if not slot:
+                    continue
+                for timer in list(slot):
+                    if timer.rounds:
+                        timer.rounds -= 1
+                    else:
+                        slot.discard(timer)
+                        timer.slot = None
+                        due.append(timer)
+            self.count -= len(due)
+        for timer in due: # callbacks may schedule again, so they run outside the lock
+            try:
+                timer.callback(*timer.args)
+            except Exception: # one failing timer must not stop the others or the loop driving the wheel
+                log.exception("timer callback %r failed", timer.callback)
+        return len(due)
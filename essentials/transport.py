@@ -0,0 +1,106 @@
+##same host fast path: modules on one box send each other datagrams over unix sockets instead of the broker
+##every module binds <directory>/<its id>.sock, a message to one module goes straight to that socket when it
+##exists and takes the payload, anything else (broadcasts, remote modules, full buffers) falls back to mqtt.
+##a datagram is one whole encoded payload, so the receiving side decodes it like one from the broker
+
+import os, socket, threading, time, logging
+
+log = logging.getLogger('samen.transport')
+
+
+class LocalTransport:
+    def __init__(self, module, directory="/run/samen", max_payload=65536, retry_after=5) -> None:
+        self.module, self.directory, self.max_payload, self.retry_after = module, directory, max_payload, retry_after
+        self.remote = {} # module -> monotonic time until which it is taken to be elsewhere
+        self.sock = self.thread = None
+        self.sent = self.fallbacks = 0
+
+    def path(self, module):
+        return os.path.join(self.directory, F"{module}.sock")
+
+    def bind(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(self.module)
+        if os.path.exists(path): # left by an earlier run, a live one would have the same id which is a misconfiguration
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 2**20)
+        self.sock.bind(path)
+        self.out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.out.setblocking(False) # a full receiver means fall back, not wait
+
+    #binds and hands every datagram to receive(payload) on a thread of its own
+    def start(self, receive):
+        if self.sock is None:
+            self.bind()
+            self.thread = threading.Thread(target=self.read_loop, args=(self.sock, receive), daemon=True)
+            self.thread.start()
+
+    #binds and reads on the event loop instead of a thread
+    def start_async(self, loop, receive):
+        if self.sock is None:
+            self.bind()
+            self.sock.setblocking(False)
+            loop.add_reader(self.sock.fileno(), self.read_ready, loop, receive)
+
+    def read_loop(self, sock, receive):
+        while True:
+            try:
+                payload = sock.recv(self.max_payload)
+            except OSError: # closed by stop()
+                return
+            if not payload: # what a shut down socket reads
+                if self.sock is not sock:
+                    return
+                continue
+            self.deliver(receive, payload)
+
+    def read_ready(self, loop, receive):
+        while self.sock is not None:
+            try:
+                payload = self.sock.recv(self.max_payload)
+            except BlockingIOError:
+                return
+            self.deliver(receive, payload)
+
+    def deliver(self, receive, payload):
+        try:
+            receive(payload)
+        except Exception: # a payload that does not decode must not stop the reader
+            log.exception("dropped a local payload")
+
+    #sends a payload to a module on this host, False if it has to go through the broker
+    def send(self, to, payload):
+        if len(payload) > self.max_payload or self.remote.get(to, 0) > time.monotonic() or self.sock is None:
+            return False
+        try:
+            self.out.sendto(payload, self.path(to))
+        except (FileNotFoundError, ConnectionRefusedError): # not on this host or not running
+            self.remote[to] = time.monotonic() + self.retry_after
+            self.fallbacks += 1
+            return False
+        except OSError: # receive buffer full or the payload is over the datagram limit
+            self.fallbacks += 1
+            return False
+        self.sent += 1
+        return True
+
+    #loop is the event loop start_async() read on
+    def stop(self, loop=None):
+        if self.sock is not None:
+            sock, self.sock = self.sock, None
+            if loop is not None:
+                loop.remove_reader(sock.fileno())
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+            self.out.close()
+            try:
+                os.unlink(self.path(self.module))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {'sent': self.sent, 'fallbacks': self.fallbacks, 'remote': sum(until > time.monotonic() for until in self.remote.values())}